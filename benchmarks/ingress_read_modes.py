@@ -0,0 +1,74 @@
+"""Rows per second & peak memory of the ingress read paths on the weather table
+
+usage: poetry run python benchmarks/ingress_read_modes.py [days]
+needs NOISYSTOCKS_DATASETS_DB_CONNECTION_URL (Postgres/Timescale, for COPY)
+
+Every read mode runs in a fresh process; peak is how far the read raises its
+peak resident memory (ru_maxrss), which includes the libpq result buffer that
+tracemalloc does not see.
+
+30 days x 20,000 grid points (600,000 rows, a 19.2 MB DataFrame), Postgres 16
+on the same machine, psycopg2 2.9, fetch_size & spool_size_in_bytes default:
+read_sql: 4.07 seconds, 147,332 rows/second, peak +283 MiB
+stream: 9.28 seconds, 64,655 rows/second, peak +49 MiB
+copy: 1.97 seconds, 304,851 rows/second, peak +49 MiB
+(copy into a BytesIO, as before the spooled file: 1.50 seconds, peak +75 MiB)"""
+import resource
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os import environ
+from time import perf_counter
+
+from noisy_stocks_data_orchestrator import ingress
+from prefect.flows import flow
+from prefect.task_runners import SequentialTaskRunner
+from sqlalchemy import create_engine
+
+READ_MODES = {
+    "read_sql": ingress.query_database,
+    "stream": ingress.stream_query_database,
+    "copy": ingress.copy_query_database,
+}
+
+
+@flow(task_runner=SequentialTaskRunner())
+def read_with_mode(read_mode: str, days: int) -> tuple[int, float, float]:
+    """rows, seconds & peak memory increase in MiB of one read"""
+    sql_alchemy_engine = create_engine(
+        environ["NOISYSTOCKS_DATASETS_DB_CONNECTION_URL"]
+    )
+    query = (
+        "SELECT timestamp, longitude, latitude, precipitation FROM weather"
+        " WHERE timestamp >= (SELECT max(timestamp) FROM weather)"
+        f" - interval '{days} days';"
+    )
+    peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = perf_counter()
+    df = READ_MODES[read_mode](sql_alchemy_engine=sql_alchemy_engine, query=query)
+    seconds = perf_counter() - start_time
+    peak_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return len(df), seconds, (peak_after - peak_before) / 2**10  # KiB on Linux
+
+
+def benchmark_read_mode(read_mode: str, days: int) -> tuple[int, float, float]:
+    """read_with_mode; a plain function, which the process pool can pickle"""
+    return read_with_mode(read_mode, days)
+
+
+def benchmark_read_modes(days: int = 30):
+    for read_mode in READ_MODES:
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=get_context("spawn")
+        ) as executor:
+            rows, seconds, peak_mib = executor.submit(
+                benchmark_read_mode, read_mode, days
+            ).result()
+        print(
+            f"{read_mode}: {rows} rows in {seconds:.2f} seconds,"
+            f" {rows / seconds:,.0f} rows/second, peak +{peak_mib:,.0f} MiB"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_read_modes(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,58 @@
+"""Seconds & peak memory of pd.pivot_table versus pivot_without_aggregation
+
+usage: poetry run python benchmarks/pivot.py [days] [grid_points]
+synthetic long weather rows: days x grid points, (latitude, longitude) col keys"""
+import sys
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from noisy_stocks_data_orchestrator.customdatastructures import (
+    pivot_without_aggregation,
+)
+
+
+def long_weather_df(days: int, grid_points: int) -> pd.DataFrame:
+    rng = np.random.default_rng(seed=0)
+    grid_side = int(np.ceil(np.sqrt(grid_points)))
+    grid = np.arange(grid_points)
+    return pd.DataFrame(
+        {
+            "latitude": np.tile(grid // grid_side * 0.5, days),
+            "longitude": np.tile(grid % grid_side * 0.5, days),
+            "precipitation": rng.gamma(shape=0.8, scale=4, size=days * grid_points),
+        },
+        index=pd.DatetimeIndex(
+            np.repeat(pd.date_range("2002-07-01", periods=days, freq="D"), grid_points),
+            name="timestamp",
+        ),
+    )
+
+
+def benchmark_pivot(days: int = 30, grid_points: int = 100_000):
+    long_df = long_weather_df(days, grid_points)
+    pivots = {
+        "pivot_table": pd.pivot_table,
+        "pivot_without_aggregation": pivot_without_aggregation,
+    }
+    for pivot_name, pivot in pivots.items():
+        tracemalloc.start()
+        start_time = perf_counter()
+        wide_df = pivot(
+            long_df,
+            index="timestamp",
+            columns=["latitude", "longitude"],
+            values="precipitation",
+        )
+        seconds = perf_counter() - start_time
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(
+            f"{pivot_name}: {len(long_df)} rows to {wide_df.shape} in"
+            f" {seconds:.2f} seconds, peak {peak_bytes / 2**20:,.0f} MiB"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_pivot(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,80 @@
+"""Peak memory of building & windowing a TimeSeries, as a multiple of the input df
+
+usage: poetry run python benchmarks/time_series_copies.py [rows] [symbols]
+compares the former separate steps (filter, dropna, sort, validate, window), each
+making a copy, with TimeSeries construction & drop_row_except"""
+import sys
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+import pandera as pa
+from noisy_stocks_data_orchestrator.customdatastructures import TimeSeries
+
+
+def long_stock_df(rows: int, symbols: int) -> pd.DataFrame:
+    rng = np.random.default_rng(seed=0)
+    days = pd.date_range("2002-07-01", periods=rows // symbols, freq="D")
+    price_close = rng.gamma(shape=2, scale=20, size=len(days) * symbols)
+    price_close[rng.random(len(price_close)) < 0.01] = 0
+    price_close[rng.random(len(price_close)) < 0.01] = np.nan
+    return pd.DataFrame(
+        {
+            "stock_symbol": np.tile(np.arange(symbols).astype(str), len(days)),
+            "price_close": price_close,
+        },
+        index=pd.DatetimeIndex(np.repeat(days, symbols), name="timestamp"),
+    )
+
+
+def separate_steps(df: pd.DataFrame, keep_list: tuple) -> pd.DataFrame:
+    schema = pa.DataFrameSchema(
+        index=pa.Index(pa.DateTime, name="timestamp", coerce=True),
+        columns={
+            "price_close": pa.Column(
+                float, checks=pa.Check.greater_than_or_equal_to(0)
+            ),
+        },
+    )
+    df = df[df["price_close"] != 0]
+    df = df.dropna()
+    df = df.sort_index(ascending=False)
+    df = schema.validate(df)
+    return df[df.index.isin(keep_list)]
+
+
+def time_series_steps(df: pd.DataFrame, keep_list: tuple) -> pd.DataFrame:
+    time_series = TimeSeries(
+        timestamp_index_name="timestamp",
+        numeric_col_name="price_close",
+        time_series_df=df,
+    )
+    time_series.drop_row_except(keep_list)
+    return time_series.time_series_df
+
+
+def benchmark_time_series_copies(rows: int = 2_000_000, symbols: int = 1000):
+    df = long_stock_df(rows, symbols)
+    input_bytes = df.memory_usage(deep=True).sum()
+    keep_list = tuple(df.index.unique()[: len(df.index.unique()) // 2])
+    pipelines = {
+        "separate_steps": separate_steps,
+        "time_series_steps": time_series_steps,
+    }
+    for pipeline_name, pipeline in pipelines.items():
+        tracemalloc.start()
+        start_time = perf_counter()
+        result_df = pipeline(df, keep_list)
+        seconds = perf_counter() - start_time
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(
+            f"{pipeline_name}: {len(df)} rows to {len(result_df)} in"
+            f" {seconds:.2f} seconds, peak {peak_bytes / input_bytes:.1f}x the input"
+            f" ({peak_bytes / 2**20:,.0f} MiB)"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_time_series_copies(*(int(arg) for arg in sys.argv[1:]))
@@ -1,9 +1,24 @@
 """Functions for correlating data"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from time import perf_counter
+from typing import Optional
+
 import numpy as np
-from numba import jit
+import pandas as pd
+from numba import float32, float64, jit, types
 from numba.typed import List as NumbaList
 from prefect.flows import flow
 from prefect.task_runners import SequentialTaskRunner
+from scipy.special import stdtr
+from scipy.stats import rankdata
+
+CORRELATION_BACKENDS = ("numba", "matrix", "rolling", "process", "dask")
+CORRELATION_SEARCHES = ("exhaustive", "streaming", "sketch", "coarse_to_fine")
+PRECISIONS = ("float64", "float32")
+CORRELATION_METHODS = ("pearson", "spearman")
 
 
 def np_mean_per_col(np_array):
@@ -18,7 +33,9 @@ def np_stdev_per_row(np_array):
 
 # BUG: Cannot assign @task to it, or will receive error; Prefect wants to pickle everything.
 # TypeError: cannot pickle '_nrt_python._MemInfo' object
-@jit(nopython=True)
+# cache=True stores the compiled kernel on disk (__pycache__ or NUMBA_CACHE_DIR),
+# so a fresh (deployment) subprocess loads it instead of compiling it again.
+@jit(nopython=True, cache=True)
 def pearson_corr(
     dataset_stdevs,
     stocks_stdevs,
@@ -71,8 +88,1115 @@ def pearson_corr(
     # calc correlation
 
 
+def standardize_cols(np_array):
+    """z-normalize every col: (x - mean) / stdev, normalized by N like np.cov(bias=True)
+
+    Keeps the dtype of np_array. Centering on the mean before any products keeps
+    float32 stable; numpy sums the cols pairwise.
+    cols without variance become NaN; their correlation is undefined, same as Series.corr"""
+    means = np_array.mean(axis=0)  # axis 0 is over rows
+    stdevs = np_array.std(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        standardized_array = (np_array - means) / stdevs
+    standardized_array[:, stdevs == 0] = np.nan
+    return standardized_array
+
+
+def pearson_corr_matrix(
+    stocks_np_array: np.ndarray,
+    dataset_np_array: np.ndarray,
+    block_size: Optional[int] = None,
+) -> np.ndarray:
+    """correlate every stock col with every dataset col using matrix multiplication
+
+    Both arrays are standardized once, after which corr = stocks_z.T @ dataset_z / N.
+    The dataset is standardized & multiplied per block of block_size cols, so the
+    standardized copy never exceeds rows x block_size. None means one single block.
+
+    output: 2D ndarray, one row per stock, one col per dataset col;
+    float32 when both inputs are float32, otherwise float64"""
+    if stocks_np_array.shape[0] != dataset_np_array.shape[0]:
+        raise ValueError("rows should be of equal size")
+
+    row_count, dataset_col_count = dataset_np_array.shape
+    if block_size is None:
+        block_size = max(dataset_col_count, 1)
+    elif block_size < 1:
+        raise ValueError("block_size should be positive")
+
+    stocks_z_transposed = standardize_stocks_transposed(stocks_np_array)
+
+    correlations = np.empty(
+        (stocks_z_transposed.shape[0], dataset_col_count),
+        dtype=np.result_type(stocks_z_transposed, dataset_np_array),
+    )
+    for block_begin in range(0, dataset_col_count, block_size):
+        block_end = min(block_begin + block_size, dataset_col_count)
+        dataset_z_block = standardize_cols(dataset_np_array[:, block_begin:block_end])
+        correlations[:, block_begin:block_end] = stocks_z_transposed @ dataset_z_block
+    return correlations
+
+
+def rank_cols(np_array):
+    """rank every col at once; ties get their average rank, like Series.rank()
+
+    Pearson correlation of the ranks is the Spearman correlation. Keeps the dtype."""
+    return rankdata(np_array, axis=0).astype(np_array.dtype, copy=False)
+
+
+def standardize_stocks_transposed(stocks_np_array):
+    """standardized stocks as (stocks x rows), with the 1/N normalization folded in
+
+    stocks are few, so folding 1/N into them is cheaper than into the dataset"""
+    return standardize_cols(stocks_np_array).T / stocks_np_array.shape[0]
+
+
+def float64_max_deviation(stocks_np_array, dataset_np_array, correlations) -> float:
+    """largest absolute difference between correlations & a float64 recalculation
+
+    use to check a reduced precision (float32) run before trusting it"""
+    correlations_float64 = pearson_corr_matrix(
+        stocks_np_array=stocks_np_array.astype(np.float64),
+        dataset_np_array=dataset_np_array.astype(np.float64),
+    )
+    return float(
+        np.nanmax(
+            np.abs(np.asarray(correlations, dtype=np.float64) - correlations_float64)
+        )
+    )
+
+
+def abs_corr_without_nan(correlations):
+    """absolute correlations where undefined (NaN) correlations rank lowest"""
+    return np.nan_to_num(np.abs(correlations), nan=-1.0)
+
+
+def top_abs_corr(correlations, top_k: int = 1, col_offset: int = 0):
+    """pick the top_k highest absolute correlations per row (stock)
+
+    output: (indexes, correlations), both stocks x top_k, sorted by descending abs corr
+    col_offset is added to the indexes; used when correlations is a block of cols"""
+    abs_correlations = abs_corr_without_nan(correlations)
+    top_k = min(top_k, correlations.shape[1])
+    # argpartition avoids a full sort over the (many) dataset cols
+    top_indexes = np.argpartition(-abs_correlations, top_k - 1, axis=1)[:, :top_k]
+    top_order = np.argsort(
+        -np.take_along_axis(abs_correlations, top_indexes, axis=1), axis=1
+    )
+    top_indexes = np.take_along_axis(top_indexes, top_order, axis=1)
+    return (
+        top_indexes + col_offset,
+        np.take_along_axis(correlations, top_indexes, axis=1),
+    )
+
+
+def streaming_top_corr(
+    stocks_np_array: np.ndarray,
+    dataset_np_array: np.ndarray,
+    block_size: int = 4096,
+    top_k: int = 1,
+):
+    """search the top_k highest absolute correlations per stock, block by block
+
+    Walks the dataset cols in blocks of block_size and keeps a running best per stock,
+    so peak memory is O(stocks x block_size) regardless of the amount of dataset cols.
+
+    output: (indexes, correlations), both stocks x top_k, sorted by descending abs corr"""
+    if stocks_np_array.shape[0] != dataset_np_array.shape[0]:
+        raise ValueError("rows should be of equal size")
+    if block_size < 1 or top_k < 1:
+        raise ValueError("block_size and top_k should be positive")
+
+    dataset_col_count = dataset_np_array.shape[1]
+    stocks_z_transposed = standardize_stocks_transposed(stocks_np_array)
+    stock_count = stocks_z_transposed.shape[0]
+
+    best_indexes = np.empty((stock_count, 0), dtype=np.int64)
+    best_correlations = np.empty(
+        (stock_count, 0), dtype=np.result_type(stocks_z_transposed, dataset_np_array)
+    )
+    for block_begin in range(0, dataset_col_count, block_size):
+        block_end = min(block_begin + block_size, dataset_col_count)
+        best_indexes, best_correlations = merge_top_abs_corr(
+            best_indexes,
+            best_correlations,
+            *block_top_abs_corr(
+                stocks_z_transposed,
+                dataset_np_array[:, block_begin:block_end],
+                col_offset=block_begin,
+                top_k=top_k,
+            ),
+            top_k=top_k,
+        )
+    return best_indexes, best_correlations
+
+
+def merge_top_abs_corr(
+    best_indexes, best_correlations, block_indexes, block_correlations, top_k=1
+):
+    """merge the running best with the best of the current block, per stock"""
+    candidate_indexes = np.concatenate((best_indexes, block_indexes), axis=1)
+    candidate_correlations = np.concatenate(
+        (best_correlations, block_correlations), axis=1
+    )
+    merged_positions, merged_correlations = top_abs_corr(
+        candidate_correlations, top_k=top_k
+    )
+    return (
+        np.take_along_axis(candidate_indexes, merged_positions, axis=1),
+        merged_correlations,
+    )
+
+
+def _shared_block_top_corr(
+    shared_memory_name: str,
+    dataset_shape,
+    dataset_dtype: str,
+    stocks_np_array: np.ndarray,
+    block_begin: int,
+    block_end: int,
+    top_k: int,
+):
+    """process pool worker: top_k of one block of dataset cols in shared memory
+
+    Plain module level function on purpose; a @task or a numba object cannot be
+    pickled to the worker (see the BUG above pearson_corr)."""
+    shared_memory = SharedMemory(name=shared_memory_name)
+    try:
+        dataset_np_array = np.ndarray(
+            dataset_shape, dtype=dataset_dtype, buffer=shared_memory.buf
+        )
+        block_indexes, block_correlations = streaming_top_corr(
+            stocks_np_array=stocks_np_array,
+            dataset_np_array=dataset_np_array[:, block_begin:block_end],
+            top_k=top_k,
+        )
+        del dataset_np_array  # release the buffer before closing
+    finally:
+        shared_memory.close()
+    return block_indexes + block_begin, block_correlations
+
+
+def process_pool_top_corr(
+    stocks_np_array: np.ndarray,
+    dataset_np_array: np.ndarray,
+    workers: Optional[int] = None,
+    block_size: Optional[int] = None,
+    top_k: int = 1,
+):
+    """search the top_k highest absolute correlations per stock on a process pool
+
+    The dataset is copied into shared memory once; every worker process maps it
+    and correlates a disjoint block of block_size dataset cols, sending back only
+    its per stock best. Workers are spawned, so they start without the parents'
+    numba threads or Prefect state.
+
+    workers: amount of processes; None means every core. workers=1 runs the
+    in-process streaming_top_corr instead.
+    block_size: None splits the dataset cols evenly over the workers
+    output: (indexes, correlations), both stocks x top_k, sorted by descending abs corr"""
+    if stocks_np_array.shape[0] != dataset_np_array.shape[0]:
+        raise ValueError("rows should be of equal size")
+    if workers is None:
+        workers = os.cpu_count() or 1
+    elif workers < 1:
+        raise ValueError("workers should be positive")
+
+    if workers == 1:
+        return streaming_top_corr(
+            stocks_np_array=stocks_np_array,
+            dataset_np_array=dataset_np_array,
+            top_k=top_k,
+        )
+
+    dataset_col_count = dataset_np_array.shape[1]
+    if block_size is None:
+        block_size = max(1, -(-dataset_col_count // workers))  # ceil
+
+    shared_memory = SharedMemory(create=True, size=max(1, dataset_np_array.nbytes))
+    try:
+        shared_dataset = np.ndarray(
+            dataset_np_array.shape,
+            dtype=dataset_np_array.dtype,
+            buffer=shared_memory.buf,
+        )
+        shared_dataset[:] = dataset_np_array
+        del shared_dataset
+
+        stock_count = stocks_np_array.shape[1]
+        best_indexes = np.empty((stock_count, 0), dtype=np.int64)
+        best_correlations = np.empty(
+            (stock_count, 0),
+            dtype=np.result_type(stocks_np_array, dataset_np_array, np.float32),
+        )
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=get_context("spawn")
+        ) as executor:
+            block_futures = [
+                executor.submit(
+                    _shared_block_top_corr,
+                    shared_memory.name,
+                    dataset_np_array.shape,
+                    dataset_np_array.dtype.str,
+                    stocks_np_array,
+                    block_begin,
+                    min(block_begin + block_size, dataset_col_count),
+                    top_k,
+                )
+                for block_begin in range(0, dataset_col_count, block_size)
+            ]
+            for block_future in block_futures:
+                best_indexes, best_correlations = merge_top_abs_corr(
+                    best_indexes,
+                    best_correlations,
+                    *block_future.result(),
+                    top_k=top_k,
+                )
+    finally:
+        shared_memory.close()
+        shared_memory.unlink()
+    return best_indexes, best_correlations
+
+
+def block_top_abs_corr(stocks_z_transposed, dataset_block, col_offset, top_k=1):
+    """top_k of one block of dataset cols; col_offset is the index of its first col"""
+    return top_abs_corr(
+        stocks_z_transposed @ standardize_cols(dataset_block),
+        top_k=top_k,
+        col_offset=col_offset,
+    )
+
+
+def _merge_top_abs_corr_pair(best, block_best, top_k=1):
+    """merge_top_abs_corr on two (indexes, correlations) tuples"""
+    return merge_top_abs_corr(*best, *block_best, top_k=top_k)
+
+
+def dask_top_corr(
+    stocks_np_array: np.ndarray,
+    dataset_np_array,
+    block_size: Optional[int] = None,
+    top_k: int = 1,
+    scheduler_address: Optional[str] = None,
+):
+    """search the top_k highest absolute correlations per stock on a dask cluster
+
+    The dataset cols are a chunked dask array (a numpy array is chunked by
+    block_size cols, default 4096); every chunk is correlated against the one
+    standardized stock matrix shared by all tasks, and the per chunk top_k are
+    merged in a tree, so only stocks x top_k results travel back.
+
+    scheduler_address: eg. "tcp://10.0.0.5:8786"; None uses the default dask
+    scheduler, which is the active distributed Client if there is one.
+    output: (indexes, correlations), both stocks x top_k, sorted by descending abs corr"""
+    # only the dask backend pays the import, not every importer & process worker
+    import dask.array as da
+    from dask import delayed
+    from dask.distributed import Client
+
+    if stocks_np_array.shape[0] != dataset_np_array.shape[0]:
+        raise ValueError("rows should be of equal size")
+    if not isinstance(dataset_np_array, da.Array):
+        dataset_np_array = da.from_array(
+            dataset_np_array, chunks=(-1, block_size or 4096)
+        )
+    elif block_size is not None:
+        dataset_np_array = dataset_np_array.rechunk((-1, block_size))
+    else:
+        dataset_np_array = dataset_np_array.rechunk({0: -1})
+
+    stocks_z_transposed = delayed(standardize_stocks_transposed(stocks_np_array))
+    col_offsets = np.cumsum((0,) + dataset_np_array.chunks[1][:-1])
+    block_bests = [
+        delayed(block_top_abs_corr)(
+            stocks_z_transposed, dataset_block, int(col_offset), top_k
+        )
+        for dataset_block, col_offset in zip(
+            dataset_np_array.to_delayed().ravel(), col_offsets
+        )
+    ]
+    while len(block_bests) > 1:
+        block_bests = [
+            delayed(_merge_top_abs_corr_pair)(*block_bests[pair : pair + 2], top_k)
+            if pair + 1 < len(block_bests)
+            else block_bests[pair]
+            for pair in range(0, len(block_bests), 2)
+        ]
+
+    if scheduler_address is None:
+        return block_bests[0].compute()
+    with Client(scheduler_address) as client:
+        return client.compute(block_bests[0]).result()
+
+
+def verify_candidates(stocks_np_array, dataset_np_array, candidate_indexes, top_k=1):
+    """exact correlations of every stock with its own candidate dataset cols only
+
+    candidate_indexes: stocks x candidates
+    output: (indexes, correlations), both stocks x top_k, sorted by descending abs corr"""
+    row_count = dataset_np_array.shape[0]
+    stock_count, candidate_count = candidate_indexes.shape
+    candidates_z = standardize_cols(
+        dataset_np_array[:, candidate_indexes.ravel()]
+    ).reshape(row_count, stock_count, candidate_count)
+    exact_correlations = np.einsum(
+        "sr,rsc->sc", standardize_stocks_transposed(stocks_np_array), candidates_z
+    )
+    positions, top_correlations = top_abs_corr(exact_correlations, top_k=top_k)
+    return np.take_along_axis(candidate_indexes, positions, axis=1), top_correlations
+
+
+def sketch_top_corr(
+    stocks_np_array: np.ndarray,
+    dataset_np_array: np.ndarray,
+    sketch_size: int = 8,
+    candidate_count: int = 16,
+    top_k: int = 1,
+    block_size: int = 4096,
+    seed: int = 0,
+):
+    """approximate search of the top_k highest absolute correlations per stock
+
+    Every z-normalized col is a unit vector over the rows; a random (gaussian)
+    projection sketches it into sketch_size numbers while roughly keeping the dot
+    products, which are the correlations. The sketches pick candidate_count
+    candidates per stock, of which only the candidates get an exact correlation.
+    Break-even: only pays off when the rows (days in the window) far outnumber
+    sketch_size; with sketch_size >= rows the sketch is no smaller than the cols,
+    so this falls back to the exact streaming_top_corr. The flow's windows of one
+    trading week (~5 rows) always take that fallback.
+
+    output: (indexes, correlations), both stocks x top_k, sorted by descending abs corr
+    The correlations are exact; only the choice of candidates is approximate."""
+    if stocks_np_array.shape[0] != dataset_np_array.shape[0]:
+        raise ValueError("rows should be of equal size")
+    if min(sketch_size, candidate_count, top_k, block_size) < 1:
+        raise ValueError(
+            "sketch_size, candidate_count, top_k & block_size should be positive"
+        )
+
+    row_count, dataset_col_count = dataset_np_array.shape
+    if sketch_size >= row_count:  # no reduction; the exact search is cheaper
+        return streaming_top_corr(
+            stocks_np_array, dataset_np_array, block_size=block_size, top_k=top_k
+        )
+    candidate_count = max(candidate_count, top_k)
+    # entries N(0, 1 / sketch_size): sketched dot products are unbiased estimates
+    projection = np.random.default_rng(seed).normal(
+        scale=1 / np.sqrt(sketch_size), size=(sketch_size, row_count)
+    )
+    # standardize_stocks_transposed folds 1/N in, sqrt(N) per side makes unit vectors
+    stocks_sketch = (
+        projection @ standardize_stocks_transposed(stocks_np_array).T
+    ) * np.sqrt(row_count)
+
+    candidate_indexes = np.empty((stocks_sketch.shape[1], 0), dtype=np.int64)
+    candidate_estimates = np.empty((stocks_sketch.shape[1], 0))
+    for block_begin in range(0, dataset_col_count, block_size):
+        block_end = min(block_begin + block_size, dataset_col_count)
+        dataset_sketch_block = (
+            projection @ standardize_cols(dataset_np_array[:, block_begin:block_end])
+        ) / np.sqrt(row_count)
+        candidate_indexes, candidate_estimates = merge_top_abs_corr(
+            candidate_indexes,
+            candidate_estimates,
+            *top_abs_corr(
+                stocks_sketch.T @ dataset_sketch_block,
+                top_k=candidate_count,
+                col_offset=block_begin,
+            ),
+            top_k=candidate_count,
+        )
+    return verify_candidates(
+        stocks_np_array, dataset_np_array, candidate_indexes, top_k=top_k
+    )
+
+
+def measure_recall(indexes, exact_indexes) -> float:
+    """share of stocks whose exact best dataset col is among the found indexes"""
+    return float(
+        np.mean([exact[0] in found for found, exact in zip(indexes, exact_indexes)])
+    )
+
+
+# candidate_count per window shape & sketch parameters, see calibrate_sketch_top_corr
+SKETCH_CALIBRATIONS: dict[tuple, int] = {}
+
+
+def calibrate_sketch_top_corr(
+    stocks_np_array: np.ndarray,
+    dataset_np_array: np.ndarray,
+    recall_target: float = 0.95,
+    recall_sample_size: int = 8,
+    sketch_size: int = 8,
+    candidate_count: int = 16,
+    top_k: int = 1,
+    block_size: int = 4096,
+    seed: int = 0,
+    calibrations: Optional[dict] = None,
+):
+    """sketch_top_corr with as many candidates as needed to reach recall_target
+
+    Measures recall against the exact kernel on a sample of recall_sample_size
+    stocks, doubling candidate_count until the recall on the sample is met.
+    The calibrated candidate_count is kept in calibrations (by default
+    SKETCH_CALIBRATIONS) per window shape, so consecutive flow runs on the same
+    shape skip the calibration. With sketch_size >= rows there is nothing to
+    calibrate; sketch_top_corr is exact then.
+
+    output: (indexes, correlations, {"candidate_count", "recall"}); recall is 1.0
+    for the exact fallback & None when a stored calibration was used"""
+    if calibrations is None:
+        calibrations = SKETCH_CALIBRATIONS
+    row_count, dataset_col_count = dataset_np_array.shape
+    calibration_key = (
+        row_count,
+        dataset_col_count,
+        sketch_size,
+        recall_target,
+        top_k,
+        seed,
+    )
+    recall = None
+    if sketch_size >= row_count:
+        recall = 1.0
+    elif calibration_key in calibrations:
+        candidate_count = calibrations[calibration_key]
+    else:
+        sample_np_array = stocks_np_array[:, :recall_sample_size]
+        exact_indexes, _ = streaming_top_corr(
+            sample_np_array, dataset_np_array, block_size=block_size
+        )
+        while True:
+            sample_indexes, _ = sketch_top_corr(
+                sample_np_array,
+                dataset_np_array,
+                sketch_size=sketch_size,
+                candidate_count=candidate_count,
+                top_k=top_k,
+                block_size=block_size,
+                seed=seed,
+            )
+            recall = measure_recall(sample_indexes, exact_indexes)
+            if recall >= recall_target or candidate_count >= dataset_col_count:
+                break
+            candidate_count *= 2
+        calibrations[calibration_key] = candidate_count
+
+    indexes, correlations = sketch_top_corr(
+        stocks_np_array,
+        dataset_np_array,
+        sketch_size=sketch_size,
+        candidate_count=candidate_count,
+        top_k=top_k,
+        block_size=block_size,
+        seed=seed,
+    )
+    return indexes, correlations, {"candidate_count": candidate_count, "recall": recall}
+
+
+def grid_cell_codes(latitudes, longitudes, pool_factor: int):
+    """code of the pooled grid cell of every col
+
+    A cell holds pool_factor x pool_factor neighbouring grid points; the grid
+    resolution is the smallest step between the coordinates.
+    output: 1D int array, cells numbered 0..cell_count - 1"""
+    grid_cells = []
+    for coordinates in (latitudes, longitudes):
+        coordinates = np.asarray(coordinates, dtype=np.float64)
+        steps = np.diff(np.unique(coordinates))
+        resolution = steps.min() if len(steps) else 1.0
+        grid_indexes = np.rint((coordinates - coordinates.min()) / resolution)
+        grid_cells.append(grid_indexes.astype(np.int64) // pool_factor)
+    _, cell_codes = np.unique(np.stack(grid_cells), axis=1, return_inverse=True)
+    return cell_codes.ravel()
+
+
+def pool_cols(np_array, cell_codes):
+    """mean of the cols per cell; cell_codes numbered 0..cell_count - 1
+
+    output: rows x cell_count"""
+    order = np.argsort(cell_codes, kind="stable")
+    sorted_codes = cell_codes[order]
+    cell_starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    cell_sizes = np.diff(np.r_[cell_starts, len(cell_codes)])
+    return np.add.reduceat(np_array[:, order], cell_starts, axis=1) / cell_sizes
+
+
+def coarse_to_fine_top_corr(
+    stocks_np_array: np.ndarray,
+    dataset_np_array: np.ndarray,
+    latitudes,
+    longitudes,
+    pool_factors=(4,),
+    refine_count: int = 4,
+    top_k: int = 1,
+):
+    """hierarchical search of the top_k highest absolute correlations per stock
+
+    Neighbouring grid points correlate strongly, so first correlate against the
+    mean of pooled cells of pool_factor x pool_factor grid points. Per stock only
+    the refine_count best cells are refined, by the next (smaller) pool factor and
+    finally at native resolution. Larger pool factors & smaller refine_count are
+    faster but more likely to miss the exhaustive best point.
+
+    latitudes & longitudes: coordinates of every dataset col
+    output: (indexes, correlations), both stocks x top_k, sorted by descending abs corr"""
+    if stocks_np_array.shape[0] != dataset_np_array.shape[0]:
+        raise ValueError("rows should be of equal size")
+    latitudes = np.asarray(latitudes)
+    longitudes = np.asarray(longitudes)
+    stock_count = stocks_np_array.shape[1]
+    stock_positions = np.arange(stock_count)[:, np.newaxis]
+
+    # candidate cols of any stock, and which of them are candidates per stock
+    candidate_cols = np.arange(dataset_np_array.shape[1])
+    candidate_mask = np.ones((stock_count, len(candidate_cols)), dtype=bool)
+    for pool_factor in sorted(pool_factors, reverse=True):
+        cell_codes = grid_cell_codes(
+            latitudes[candidate_cols], longitudes[candidate_cols], pool_factor
+        )
+        cell_correlations = pearson_corr_matrix(
+            stocks_np_array, pool_cols(dataset_np_array[:, candidate_cols], cell_codes)
+        )
+        # cells without candidate cols for a stock are out of the race
+        stock_cells = np.zeros(cell_correlations.shape, dtype=bool)
+        mask_stocks, mask_cols = np.nonzero(candidate_mask)
+        stock_cells[mask_stocks, cell_codes[mask_cols]] = True
+        cell_correlations[~stock_cells] = np.nan
+
+        best_cells, _ = top_abs_corr(cell_correlations, top_k=refine_count)
+        chosen_cells = np.zeros(cell_correlations.shape, dtype=bool)
+        chosen_cells[stock_positions, best_cells] = True
+        candidate_mask &= chosen_cells[:, cell_codes]
+
+        remaining_cols = candidate_mask.any(axis=0)
+        candidate_cols = candidate_cols[remaining_cols]
+        candidate_mask = candidate_mask[:, remaining_cols]
+
+    correlations = pearson_corr_matrix(
+        stocks_np_array, dataset_np_array[:, candidate_cols]
+    )
+    correlations[~candidate_mask] = np.nan
+    positions, top_correlations = top_abs_corr(correlations, top_k=top_k)
+    return candidate_cols[positions], top_correlations
+
+
+def lag1_autocorrelations(np_array):
+    """lag-1 autocorrelation per col; cols without variance get 0"""
+    centered = np_array - np_array.mean(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        autocorrelations = (centered[1:] * centered[:-1]).sum(axis=0) / (
+            centered * centered
+        ).sum(axis=0)
+    return np.nan_to_num(autocorrelations, nan=0.0)
+
+
+def effective_row_counts(row_count, stocks_autocorrelations, dataset_autocorrelations):
+    """effective sample size of autocorrelated series (Bretherton et al. 1999)
+
+    n_eff = n (1 - r1x r1y) / (1 + r1x r1y), capped between 3 and n.
+    The autocorrelations broadcast; pass them as a col & a row for every pair"""
+    autocorrelation_products = stocks_autocorrelations * dataset_autocorrelations
+    return np.clip(
+        row_count * (1 - autocorrelation_products) / (1 + autocorrelation_products),
+        3,
+        row_count,
+    )
+
+
+def correlation_p_values(correlations, row_counts):
+    """two-sided p-values of the t-test for Pearson correlations
+
+    t = r sqrt((n - 2) / (1 - r^2)) with n - 2 degrees of freedom; row_counts is a
+    scalar or broadcasts against correlations (eg. effective_row_counts)
+
+    output: (t_statistics, p_values), same shape as correlations"""
+    degrees_of_freedom = np.asarray(row_counts, dtype=np.float64) - 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_statistics = correlations * np.sqrt(
+            degrees_of_freedom / (1 - correlations * correlations)
+        )
+    # |r| == 1 gives an infinite t, stdtr handles it as p 0
+    p_values = 2 * stdtr(degrees_of_freedom, -np.abs(t_statistics))
+    return t_statistics, p_values
+
+
+def benjamini_hochberg(p_values):
+    """false discovery rate adjusted p-values (q-values) along the last axis
+
+    every stock (row) is its own family of tests over the dataset cols"""
+    p_values = np.asarray(p_values, dtype=np.float64)
+    test_count = p_values.shape[-1]
+    order = np.argsort(p_values, axis=-1)
+    sorted_p_values = np.take_along_axis(p_values, order, axis=-1)
+    ranks = np.arange(1, test_count + 1)
+    # q_(i) = min over j >= i of p_(j) m / j
+    sorted_q_values = np.minimum.accumulate(
+        (sorted_p_values * test_count / ranks)[..., ::-1], axis=-1
+    )[..., ::-1]
+    q_values = np.empty_like(sorted_q_values)
+    np.put_along_axis(q_values, order, np.minimum(sorted_q_values, 1), axis=-1)
+    return q_values
+
+
+def max_statistic_p_values(p_values, test_count):
+    """family wise p-value of the best out of test_count independent tests (Sidak)
+
+    1 - (1 - p)^m; use it for the max |r| of a stock over every dataset col.
+    p = 1 gives log1p(-1) = -inf, thus exactly 1"""
+    with np.errstate(divide="ignore"):
+        return -np.expm1(test_count * np.log1p(-np.asarray(p_values, dtype=np.float64)))
+
+
+def correlation_significance(
+    correlations, stocks_np_array, dataset_np_array, effective_sample_size=True
+):
+    """significance of a full stocks x dataset cols correlation matrix, vectorized
+
+    effective_sample_size: correct the row count for the lag-1 autocorrelation of
+    both series, otherwise the p-values of time series come out too optimistic
+
+    output: dict with t_statistics, p_values, q_values (Benjamini-Hochberg per stock)
+    and row_counts, every array of the shape of correlations"""
+    row_count = stocks_np_array.shape[0]
+    if effective_sample_size:
+        row_counts = effective_row_counts(
+            row_count,
+            lag1_autocorrelations(stocks_np_array)[:, np.newaxis],
+            lag1_autocorrelations(dataset_np_array)[np.newaxis, :],
+        )
+    else:
+        row_counts = np.full(np.shape(correlations), float(row_count))
+    t_statistics, p_values = correlation_p_values(correlations, row_counts)
+    return {
+        "t_statistics": t_statistics,
+        "p_values": p_values,
+        "q_values": benjamini_hochberg(np.nan_to_num(p_values, nan=1.0)),
+        "row_counts": row_counts,
+    }
+
+
+def top_correlation_significance(
+    stocks_np_array, dataset_np_array, top_indexes, top_correlations
+):
+    """significance of the best correlation per stock, as found by a search
+
+    The best of many dataset cols is significant by chance alone, so next to its
+    own p-value it gets a family wise p-value over every dataset col (max-statistic).
+    Needs only the top matches; works after any search, streaming included.
+
+    top_indexes & top_correlations: 1D, one per stock
+    output: dict with p_values & family_p_values, 1D arrays one per stock"""
+    row_counts = effective_row_counts(
+        stocks_np_array.shape[0],
+        lag1_autocorrelations(stocks_np_array),
+        lag1_autocorrelations(dataset_np_array[:, top_indexes]),
+    )
+    _, p_values = correlation_p_values(top_correlations, row_counts)
+    return {
+        "p_values": p_values,
+        "family_p_values": max_statistic_p_values(
+            p_values, test_count=dataset_np_array.shape[1]
+        ),
+    }
+
+
+# BUG: Not a pydantic BaseModel on purpose; Prefect rebuilds models passed as flow
+# parameters, which would drop the sums of the previous window.
+class RollingCorrelation:
+    """Pearson correlations of a sliding window, updated as days enter & leave it
+
+    Keeps the running sum of products (sum xy) per stock / dataset col pair of the
+    previous window. On update only the days that left & entered the window are
+    subtracted & added; stock & dataset cols that are new to the window get their
+    sums from scratch. The per col sums (sum x, sum x^2, sum y, sum y^2) are cheap
+    and are taken from the current window directly.
+
+    Values are shifted by a fixed per col reference value before summing, which
+    keeps the sum of squares formula stable. Assumes the value of a (day, col)
+    never changes between updates; call reset() after re-ingesting data.
+    The caller owns the engine (see precompute_content); one per sequence of
+    windows, never shared between concurrent runs."""
+
+    def __init__(self):
+        self.full_calculation_count = 0  # how often every product was summed
+        self.incremental_update_count = 0  # how often only the delta days were summed
+        self._row_labels: Optional[pd.Index] = None
+        self._stock_labels: Optional[pd.Index] = None
+        self._dataset_labels: Optional[pd.Index] = None
+        self._stocks_np_array: Optional[np.ndarray] = None
+        self._dataset_np_array: Optional[np.ndarray] = None
+        self._stock_shifts: Optional[np.ndarray] = None
+        self._dataset_shifts: Optional[np.ndarray] = None
+        self._sum_xy: Optional[np.ndarray] = None
+
+    def reset(self):
+        """forget the previous window; the next update sums every product"""
+        self._row_labels = None
+
+    def update(
+        self,
+        row_labels,
+        stocks_np_array: np.ndarray,
+        dataset_np_array: np.ndarray,
+        stock_labels=None,
+        dataset_labels=None,
+    ) -> np.ndarray:
+        """correlate the window, reusing the sums of the previous window
+
+        row_labels: one unique label per row, eg. the timestamps of the window
+        stock_labels & dataset_labels: one label per col, default col positions
+
+        output: 2D ndarray, one row per stock, one col per dataset col"""
+        if not (
+            stocks_np_array.shape[0] == dataset_np_array.shape[0] == len(row_labels)
+        ):
+            raise ValueError("rows should be of equal size")
+        row_labels = pd.Index(row_labels)
+        stock_labels = pd.Index(
+            range(stocks_np_array.shape[1]) if stock_labels is None else stock_labels
+        )
+        dataset_labels = pd.Index(
+            range(dataset_np_array.shape[1])
+            if dataset_labels is None
+            else dataset_labels
+        )
+        if not row_labels.is_unique:
+            raise ValueError("row_labels should be unique")
+
+        entering_rows = ~row_labels.isin(
+            [] if self._row_labels is None else self._row_labels
+        )
+        if self._row_labels is None or entering_rows.sum() * 2 >= len(row_labels):
+            # no previous window, or too little overlap to pay off
+            self._calculate_from_scratch(
+                stocks_np_array, dataset_np_array, stock_labels, dataset_labels
+            )
+        else:
+            self._update_incrementally(
+                row_labels,
+                entering_rows,
+                stocks_np_array,
+                dataset_np_array,
+                stock_labels,
+                dataset_labels,
+            )
+        self._row_labels = row_labels
+        self._stock_labels = stock_labels
+        self._dataset_labels = dataset_labels
+        self._stocks_np_array = stocks_np_array
+        self._dataset_np_array = dataset_np_array
+        return self._correlations()
+
+    def _calculate_from_scratch(
+        self, stocks_np_array, dataset_np_array, stock_labels, dataset_labels
+    ):
+        self._stock_shifts = stocks_np_array[0].astype(np.float64)
+        self._dataset_shifts = dataset_np_array[0].astype(np.float64)
+        self._sum_xy = (stocks_np_array - self._stock_shifts).T @ (
+            dataset_np_array - self._dataset_shifts
+        )
+        self.full_calculation_count += 1
+
+    def _update_incrementally(
+        self,
+        row_labels,
+        entering_rows,
+        stocks_np_array,
+        dataset_np_array,
+        stock_labels,
+        dataset_labels,
+    ):
+        # where are the current cols & rows located in the previous window?
+        stock_positions = self._stock_labels.get_indexer(stock_labels)
+        dataset_positions = self._dataset_labels.get_indexer(dataset_labels)
+        known_stocks = stock_positions >= 0
+        known_datapoints = dataset_positions >= 0
+        leaving_rows = ~self._row_labels.isin(row_labels)
+
+        # new cols get the first value of the window as reference value
+        stock_shifts = stocks_np_array[0].astype(np.float64)
+        stock_shifts[known_stocks] = self._stock_shifts[stock_positions[known_stocks]]
+        dataset_shifts = dataset_np_array[0].astype(np.float64)
+        dataset_shifts[known_datapoints] = self._dataset_shifts[
+            dataset_positions[known_datapoints]
+        ]
+        stocks_shifted = stocks_np_array - stock_shifts
+        dataset_shifted = dataset_np_array - dataset_shifts
+
+        sum_xy = np.empty((len(stock_labels), len(dataset_labels)))
+        # known stock x known datapoint: previous sums + entering - leaving days
+        known_block = np.ix_(known_stocks, known_datapoints)
+        sum_xy[known_block] = self._sum_xy[
+            np.ix_(stock_positions[known_stocks], dataset_positions[known_datapoints])
+        ]
+        sum_xy[known_block] += (
+            stocks_shifted[np.ix_(entering_rows, known_stocks)].T
+            @ dataset_shifted[np.ix_(entering_rows, known_datapoints)]
+        )
+        sum_xy[known_block] -= (
+            self._stocks_np_array[np.ix_(leaving_rows, stock_positions[known_stocks])]
+            - stock_shifts[known_stocks]
+        ).T @ (
+            self._dataset_np_array[
+                np.ix_(leaving_rows, dataset_positions[known_datapoints])
+            ]
+            - dataset_shifts[known_datapoints]
+        )
+        # new stocks or new datapoints: sum over the full window
+        sum_xy[~known_stocks] = stocks_shifted[:, ~known_stocks].T @ dataset_shifted
+        sum_xy[np.ix_(known_stocks, ~known_datapoints)] = (
+            stocks_shifted[:, known_stocks].T @ dataset_shifted[:, ~known_datapoints]
+        )
+
+        self._stock_shifts = stock_shifts
+        self._dataset_shifts = dataset_shifts
+        self._sum_xy = sum_xy
+        self.incremental_update_count += 1
+
+    def _correlations(self):
+        row_count = self._stocks_np_array.shape[0]
+        stocks_shifted = self._stocks_np_array - self._stock_shifts
+        dataset_shifted = self._dataset_np_array - self._dataset_shifts
+        sum_x = stocks_shifted.sum(axis=0)
+        sum_y = dataset_shifted.sum(axis=0)
+        # row_count x variance & covariance
+        var_x = (stocks_shifted * stocks_shifted).sum(
+            axis=0
+        ) - sum_x * sum_x / row_count
+        var_y = (dataset_shifted * dataset_shifted).sum(
+            axis=0
+        ) - sum_y * sum_y / row_count
+        covariances = self._sum_xy - np.outer(sum_x, sum_y) / row_count
+        with np.errstate(divide="ignore", invalid="ignore"):
+            correlations = covariances / np.sqrt(np.outer(var_x, var_y))
+        # cols without variance have an undefined correlation, same as Series.corr
+        correlations[var_x <= 0] = np.nan
+        correlations[:, var_y <= 0] = np.nan
+        return correlations
+
+
+@flow(task_runner=SequentialTaskRunner())
+def correlate_datasets(
+    *args,
+    backend: str = "numba",
+    block_size=None,
+    workers=None,
+    top_k=1,
+    scheduler_address=None,
+    **kwargs,
+):
+    """correlate every stock with every dataset col
+
+    backend "numba": per pair kernel pearson_corr, returns a list of arrays per stock;
+    C or Fortran ordered input is passed as is, mixed input becomes Fortran ordered
+    backend "matrix": pearson_corr_matrix, returns a 2D ndarray (stocks x dataset cols);
+    the recommended backend
+    backend "rolling": updates the RollingCorrelation passed as rolling_correlation
+    with row_labels, stock_labels & dataset_labels, returns a 2D ndarray
+    Iterating over these outputs yields one correlation array per stock.
+    backend "process": process_pool_top_corr on workers processes, only returns
+    the per stock best: (indexes, correlations), both stocks x top_k
+    backend "dask": dask_top_corr on the cluster at scheduler_address, returns the
+    per stock best like backend "process"."""
+    if backend == "numba":
+        if "stocks_stdevs" not in kwargs:
+            kwargs["stocks_stdevs"] = np_stdev_per_row(kwargs["stocks_np_array"])
+        if "dataset_stdevs" not in kwargs:
+            kwargs["dataset_stdevs"] = np_stdev_per_row(kwargs["dataset_np_array"])
+        array_names = ("stocks_np_array", "dataset_np_array")
+        # both C or both Fortran contiguous, matching KERNEL_SIGNATURES; only
+        # other input is copied, to Fortran order (the kernel reads whole cols)
+        if not all(kwargs[name].flags.c_contiguous for name in array_names):
+            for array_name in array_names:
+                kwargs[array_name] = np.asfortranarray(kwargs[array_name])
+        return list(
+            pearson_corr(*args, **kwargs)
+        )  # convert back from NumbaList to regular Python list
+    elif backend == "matrix":
+        return pearson_corr_matrix(
+            stocks_np_array=kwargs["stocks_np_array"],
+            dataset_np_array=kwargs["dataset_np_array"],
+            block_size=block_size,
+        )
+    elif backend == "rolling":
+        if kwargs.get("rolling_correlation") is None:
+            raise ValueError("backend rolling needs a RollingCorrelation")
+        return kwargs["rolling_correlation"].update(
+            row_labels=kwargs["row_labels"],
+            stocks_np_array=kwargs["stocks_np_array"],
+            dataset_np_array=kwargs["dataset_np_array"],
+            stock_labels=kwargs.get("stock_labels"),
+            dataset_labels=kwargs.get("dataset_labels"),
+        )
+    elif backend == "process":
+        return process_pool_top_corr(
+            stocks_np_array=kwargs["stocks_np_array"],
+            dataset_np_array=kwargs["dataset_np_array"],
+            workers=workers,
+            block_size=block_size,
+            top_k=top_k,
+        )
+    elif backend == "dask":
+        return dask_top_corr(
+            stocks_np_array=kwargs["stocks_np_array"],
+            dataset_np_array=kwargs["dataset_np_array"],
+            block_size=block_size,
+            top_k=top_k,
+            scheduler_address=scheduler_address,
+        )
+    raise ValueError(f"backend should be one of {CORRELATION_BACKENDS}")
+
+
 @flow(task_runner=SequentialTaskRunner())
-def correlate_datasets(*args, **kwargs):
-    return list(
-        pearson_corr(*args, **kwargs)
-    )  # convert back from NumbaList to regular Python list
+def find_highest_correlations(
+    stocks_np_array,
+    dataset_np_array,
+    search: str = "exhaustive",
+    backend: str = "matrix",
+    block_size: Optional[int] = None,
+    top_k: int = 1,
+    workers: Optional[int] = None,
+    row_labels=None,
+    stock_labels=None,
+    dataset_labels=None,
+    method: str = "pearson",
+    recall_target: float = 0.95,
+    sketch_size: int = 8,
+    pool_factors=(4,),
+    refine_count: int = 4,
+    coordinate_names=("latitude", "longitude"),
+    recall_sample_size: int = 8,
+    scheduler_address: Optional[str] = None,
+    rolling_correlation=None,  # RollingCorrelation
+):
+    """per stock, find the dataset cols with the highest absolute correlation
+
+    method "pearson" or "spearman"; spearman ranks both arrays once up front and
+    then runs the same search & backend on the ranks
+
+    search "exhaustive": correlate_datasets with backend, then pick the top_k
+    (the labels & rolling_correlation are only used by the rolling backend,
+    scheduler_address by dask)
+    search "streaming": streaming_top_corr; never holds the full correlation matrix
+    search "sketch": calibrate_sketch_top_corr; approximate, aims for recall_target
+    and prints the recall it measured against the exact search; exact for windows
+    of at most sketch_size rows, where sketching does not pay off
+    search "coarse_to_fine": coarse_to_fine_top_corr over the dataset_labels levels
+    coordinate_names; prints how often it agrees with the exact search
+
+    output: (indexes, correlations), both stocks x top_k, sorted by descending abs corr"""
+    if method == "spearman":
+        if backend == "rolling" and search == "exhaustive":
+            # ranks are relative to the window, previous sums do not carry over
+            raise ValueError("spearman cannot use the rolling backend")
+        stocks_np_array = rank_cols(stocks_np_array)
+        dataset_np_array = rank_cols(dataset_np_array)
+    elif method != "pearson":
+        raise ValueError(f"method should be one of {CORRELATION_METHODS}")
+
+    if search == "exhaustive":
+        label_kwargs = {}
+        if backend == "rolling":
+            label_kwargs = {
+                "row_labels": row_labels,
+                "stock_labels": stock_labels,
+                "dataset_labels": dataset_labels,
+                "rolling_correlation": rolling_correlation,
+            }
+        correlations = correlate_datasets(
+            backend=backend,
+            block_size=block_size,
+            workers=workers,
+            stocks_np_array=stocks_np_array,
+            dataset_np_array=dataset_np_array,
+            top_k=top_k,
+            scheduler_address=scheduler_address,
+            **label_kwargs,
+        )
+        if backend in ("process", "dask"):
+            return correlations  # the workers already picked the top_k
+        return top_abs_corr(np.array(correlations), top_k=top_k)
+    elif search == "streaming":
+        return streaming_top_corr(
+            stocks_np_array=stocks_np_array,
+            dataset_np_array=dataset_np_array,
+            block_size=block_size or 4096,
+            top_k=top_k,
+        )
+    elif search == "sketch":
+        indexes, correlations, recall_report = calibrate_sketch_top_corr(
+            stocks_np_array=stocks_np_array,
+            dataset_np_array=dataset_np_array,
+            recall_target=recall_target,
+            recall_sample_size=recall_sample_size,
+            sketch_size=sketch_size,
+            top_k=top_k,
+            block_size=block_size or 4096,
+        )
+        print(f"sketch search recall against exact search: {recall_report}")
+        return indexes, correlations
+    elif search == "coarse_to_fine":
+        latitude_name, longitude_name = coordinate_names
+        indexes, correlations = coarse_to_fine_top_corr(
+            stocks_np_array=stocks_np_array,
+            dataset_np_array=dataset_np_array,
+            latitudes=dataset_labels.get_level_values(latitude_name),
+            longitudes=dataset_labels.get_level_values(longitude_name),
+            pool_factors=pool_factors,
+            refine_count=refine_count,
+            top_k=top_k,
+        )
+        exact_indexes, _ = streaming_top_corr(
+            stocks_np_array[:, :recall_sample_size], dataset_np_array
+        )
+        agreement = measure_recall(indexes[:recall_sample_size], exact_indexes)
+        print(f"coarse to fine search agrees with exact search for: {agreement}")
+        return indexes, correlations
+    raise ValueError(f"search should be one of {CORRELATION_SEARCHES}")
+
+
+# explicit signatures per kernel: 2D arrays in float64 & float32, both C or both
+# Fortran contiguous; numba compiles one variant per exact layout, and pivoted
+# frames hand over either, depending on the pandas operations after the pivot.
+# Callers convert only mixed input, otherwise numba compiles yet another variant.
+KERNEL_SIGNATURES = {
+    pearson_corr: [
+        (types.ListType(float64), types.ListType(float64), array_type, array_type)
+        for dtype in (float64, float32)
+        for array_type in (dtype[:, ::1], dtype[::1, :])
+    ],
+}
+
+
+# the numba kernel behind each numba backend of correlate_datasets
+BACKEND_KERNELS = {"numba": pearson_corr}
+
+
+def warm_up_kernels(backend: Optional[str] = None) -> dict[str, float]:
+    """compile the numba kernels for KERNEL_SIGNATURES
+
+    With a filled on disk cache this only loads the kernels. Optionally run it
+    once after installing (make warmup) so later flow runs skip compilation.
+    backend: only the kernel of that backend (see BACKEND_KERNELS); None for all
+
+    output: {kernel name: seconds spent compiling or loading}"""
+    kernels = KERNEL_SIGNATURES
+    if backend is not None:
+        kernels = {
+            kernel: signatures
+            for kernel, signatures in KERNEL_SIGNATURES.items()
+            if kernel is BACKEND_KERNELS.get(backend)
+        }
+    compile_seconds = {}
+    for kernel, signatures in kernels.items():
+        start_time = perf_counter()
+        for signature in signatures:
+            kernel.compile(signature)
+        compile_seconds[kernel.py_func.__name__] = perf_counter() - start_time
+    return compile_seconds
+
+
+if __name__ == "__main__":
+    print(f"numba kernels compiled or loaded in seconds: {warm_up_kernels()}")
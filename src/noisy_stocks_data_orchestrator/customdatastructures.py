@@ -1,19 +1,27 @@
 """Custom data structures and their methods
     """
 
-from datetime import datetime, timedelta
+import json
+from datetime import date, datetime, timedelta
 from pathlib import Path
+from time import perf_counter
 from typing import Optional
 
+import numpy as np
 import pandas as pd
 import pandera as pa
+import sqlalchemy as sa
 from pandas import DataFrame
 from pandera import Index
 from pandera.dtypes import Timestamp
+from pandera.errors import SchemaError
 from prefect.tasks import task
 from pydantic import BaseModel, PrivateAttr, validate_arguments
 from pydantic.types import PositiveInt
 
+VALIDATION_MODES = ("pandera", "numpy", "sampled")
+DAY_IN_NS = pd.Timedelta(days=1).value
+
 
 @validate_arguments
 @task(retries=5, retry_delay_seconds=5)
@@ -29,6 +37,93 @@ def folder_exists(path: Path):
     return path.is_dir()
 
 
+def _label_values(df: DataFrame, label: str):
+    """values of a col, or of an index level with that name"""
+    if label in df.index.names:
+        return df.index.get_level_values(label)
+    return df[label]
+
+
+def pivot_without_aggregation(
+    df: DataFrame, index: str, columns, values: str
+) -> Optional[DataFrame]:
+    """long to wide like pd.pivot_table, by scattering the values into a dense matrix
+
+    Factorizes the index and (every) columns key to integer codes; rows with a
+    NaN value or a NaN/NaT key are left out, as pivot_table does (factorize codes
+    those keys -1, which would scatter into the wrong cell). Rows & cols are sorted.
+    output: the wide df, or None if an index & columns pair occurs more than once
+    (then the duplicates need pivot_table's mean)"""
+    column_keys = [columns] if isinstance(columns, str) else list(columns)
+    value_array = np.asarray(df[values])
+    is_complete = ~pd.isna(value_array)
+    for key in [index, *column_keys]:
+        is_complete &= ~pd.isna(np.asarray(_label_values(df, key)))
+    value_array = value_array[is_complete]
+
+    row_codes, row_labels = pd.factorize(
+        _label_values(df, index)[is_complete], sort=True
+    )
+    col_codes = np.zeros(len(value_array), dtype=np.int64)
+    key_uniques = []
+    for column_key in column_keys:
+        key_codes, key_labels = pd.factorize(
+            _label_values(df, column_key)[is_complete], sort=True
+        )
+        col_codes = col_codes * len(key_labels) + key_codes
+        key_uniques.append(key_labels)
+    # the combined codes keep the lexicographic order of the keys
+    col_codes, combined_codes = pd.factorize(col_codes, sort=True)
+
+    flat_codes = row_codes.astype(np.int64) * len(combined_codes) + col_codes
+    if not pd.Index(flat_codes).is_unique:
+        return None
+
+    # categorical (compact) keys become plain labels, as without compact ingest
+    key_uniques = [np.asarray(key_labels) for key_labels in key_uniques]
+    if len(column_keys) == 1:
+        col_labels = pd.Index(key_uniques[0][combined_codes], name=column_keys[0])
+    else:
+        key_positions = []
+        for key_labels in reversed(key_uniques):
+            key_positions.append(combined_codes % len(key_labels))
+            combined_codes = combined_codes // len(key_labels)
+        col_labels = pd.MultiIndex.from_arrays(
+            [
+                key_labels[positions]
+                for key_labels, positions in zip(key_uniques, reversed(key_positions))
+            ],
+            names=column_keys,
+        )
+
+    wide_np_array = np.full(
+        (len(row_labels), len(col_labels)),
+        np.nan,
+        dtype=np.result_type(value_array.dtype, np.float32),
+    )
+    wide_np_array.ravel()[flat_codes] = value_array
+    return DataFrame(
+        wide_np_array,
+        index=pd.Index(row_labels, name=index),
+        columns=col_labels,
+        copy=False,
+    )
+
+
+def longest_run(mask: np.ndarray) -> tuple[int, int]:
+    """position & length of the longest run of True values; on a tie the last run
+
+    run-length by diff: a run starts where the padded mask goes 0 -> 1 and ends
+    where it goes 1 -> 0. output: (0, 0) if the mask has no True value"""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    run_starts = np.flatnonzero(edges == 1)
+    if len(run_starts) == 0:
+        return 0, 0
+    run_lengths = np.flatnonzero(edges == -1) - run_starts
+    last_longest_run = len(run_lengths) - 1 - np.argmax(run_lengths[::-1])
+    return int(run_starts[last_longest_run]), int(run_lengths[last_longest_run])
+
+
 class CorrDatabaseQuery(BaseModel):
     """values and variables related to analysis ingestion stage.
 
@@ -46,10 +141,132 @@ class CorrDatabaseQuery(BaseModel):
     _end_timestamp: datetime = PrivateAttr()
     target_date: Optional[datetime] = None
     days_ago: Optional[PositiveInt] = None
+    # pushdown; filter in the database instead of in pandas, see to_selectable
+    filter_numeric_col_name: Optional[str] = None  # leave out NULL & 0 values
+    complete_uid_col_names: Optional[list[str]] = None  # eg. latitude, longitude
+    sql_dialect: str = "postgresql"  # to compile the pushdown query for
+
+    def _is_pushdown(self) -> bool:
+        return (
+            self.filter_numeric_col_name is not None
+            or self.complete_uid_col_names is not None
+        )
+
+    def _table_and_conditions(self):
+        """the sqlalchemy table & the conditions of the interval, with the NULL &
+        0 filter of filter_numeric_col_name"""
+        table = sa.table(
+            self.from_database, *(sa.column(field) for field in self.select_fields)
+        )
+        conditions = [
+            table.c.timestamp >= str(self._begin_timestamp.date()),
+            table.c.timestamp <= str(self._end_timestamp.date()),
+        ]
+        if self.filter_numeric_col_name is not None:
+            numeric_col = table.c[self.filter_numeric_col_name]
+            conditions += [numeric_col.isnot(None), numeric_col != 0]
+        return table, conditions
+
+    def _complete_uids_selectable(self):
+        """sqlalchemy select of the filtered table & of its complete uids:
+        HAVING count(DISTINCT timestamp) = the days in the filtered interval"""
+        table, conditions = self._table_and_conditions()
+        filtered = sa.select(*table.c).where(sa.and_(*conditions)).cte("filtered")
+        uid_cols = [filtered.c[name] for name in self.complete_uid_col_names]
+        window_days = sa.select(
+            sa.func.count(sa.distinct(filtered.c.timestamp))
+        ).scalar_subquery()
+        complete_uids = (
+            sa.select(*uid_cols)
+            .group_by(*uid_cols)
+            .having(sa.func.count(sa.distinct(filtered.c.timestamp)) == window_days)
+        )
+        return filtered, complete_uids
+
+    def to_selectable(
+        self,
+        partition: Optional[tuple[date, date]] = None,
+        complete_uids: Optional[list[tuple]] = None,
+    ):
+        """sqlalchemy select of the interval, applying the pushdown filters
+
+        filter_numeric_col_name: leaves out rows with a NULL or 0 value, as
+        TimeSeries does
+        complete_uid_col_names: only the points (eg. grid points) with a value on
+        every day with any value, as dropna(axis=1) after pivot_rows_to_cols does;
+        HAVING count(DISTINCT timestamp) = the days in the filtered interval
+        partition: (begin, end) days, end excluded; only the rows of those days.
+        The completeness stays over the whole interval.
+        complete_uids: the rows of to_complete_uids_sql, already aggregated once;
+        filters the uids with IN instead of aggregating the interval again"""
+        table, conditions = self._table_and_conditions()
+
+        def partition_conditions(timestamp_col):
+            if partition is None:
+                return []
+            return [
+                timestamp_col >= str(partition[0]),
+                timestamp_col < str(partition[1]),
+            ]
+
+        if self.complete_uid_col_names is None:
+            return sa.select(*table.c).where(
+                sa.and_(*conditions, *partition_conditions(table.c.timestamp))
+            )
+
+        if complete_uids is not None:
+            uid_cols = [table.c[name] for name in self.complete_uid_col_names]
+            if not complete_uids:  # an empty IN does not compile for every dialect
+                is_complete = sa.false()
+            elif len(uid_cols) == 1:
+                is_complete = uid_cols[0].in_([uid for (uid,) in complete_uids])
+            else:
+                is_complete = sa.tuple_(*uid_cols).in_(complete_uids)
+            return sa.select(*table.c).where(
+                sa.and_(
+                    *conditions, *partition_conditions(table.c.timestamp), is_complete
+                )
+            )
+
+        filtered, complete_uids_selectable = self._complete_uids_selectable()
+        complete = complete_uids_selectable.subquery("complete")
+        complete_selectable = sa.select(*filtered.c).join(
+            complete,
+            sa.and_(
+                *(
+                    filtered.c[name] == complete.c[name]
+                    for name in self.complete_uid_col_names
+                )
+            ),
+        )
+        if partition is None:
+            return complete_selectable
+        return complete_selectable.where(
+            sa.and_(*partition_conditions(filtered.c.timestamp))
+        )
+
+    def to_complete_uids_sql(self) -> str:
+        """output sql query of the complete uids over the whole interval (see
+        to_selectable); run it once, then pass its rows to to_sql_partitions"""
+        if self.complete_uid_col_names is None:
+            raise ValueError("Expected complete_uid_col_names")
+        return self._compile(self._complete_uids_selectable()[1])
+
+    def _compile(self, selectable) -> str:
+        """sql string of a selectable, the values inlined, for sql_dialect"""
+        return str(
+            selectable.compile(
+                dialect=sa.engine.make_url(f"{self.sql_dialect}://").get_dialect()(),
+                compile_kwargs={"literal_binds": True},
+            )
+        )
 
     def to_sql(self):
-        """output sql query"""
-        # TODO: Refactor to sqlalchemy query
+        """output sql query
+
+        with pushdown filters the compiled to_selectable, else the legacy query"""
+        if self._is_pushdown():
+            return self._compile(self.to_selectable())
         stocks_query = (
             r"SELECT "
             + self._unfold_select_fields()
@@ -69,6 +286,39 @@ class CorrDatabaseQuery(BaseModel):
         )
         return stocks_query
 
+    def to_sql_partitions(
+        self,
+        days_per_partition: PositiveInt = 1,
+        complete_uids: Optional[list[tuple]] = None,
+    ) -> list[str]:
+        """output one sql query per days_per_partition days of the interval;
+        together they select the same rows as to_sql
+
+        Each is the compiled to_selectable of its days; with pushdown filters the
+        NULL & 0 filter applies per partition, the completeness per interval.
+        With complete_uid_col_names, complete_uids (the rows of
+        to_complete_uids_sql) is required, so no partition aggregates the whole
+        interval again."""
+        if self.complete_uid_col_names is not None and complete_uids is None:
+            raise ValueError("Expected complete_uids, the rows of to_complete_uids_sql")
+        partition_begin_date = self._begin_timestamp.date()
+        end_date = self._end_timestamp.date()
+        partition_queries = []
+        while partition_begin_date <= end_date:
+            partition_end_date = partition_begin_date + timedelta(
+                days=int(days_per_partition)
+            )
+            partition_queries.append(
+                self._compile(
+                    self.to_selectable(
+                        partition=(partition_begin_date, partition_end_date),
+                        complete_uids=complete_uids,
+                    )
+                )
+            )
+            partition_begin_date = partition_end_date
+        return partition_queries
+
     def calculate_target_date(self):
         if self.target_date is None:
             if self.days_ago is None:
@@ -160,6 +410,9 @@ class TimeSeries(BaseModel):
     timestamp_index_name: str  # What is the name of the timestamp column?
     numeric_col_name: str  # What is the name of the numeric column? eg. price_close
     time_series_df: pd.DataFrame  # DataFrame with timestamp as index, sorted DESC
+    is_pivoted: bool = False  # already wide & clean, eg. a PrecipitationCube window
+    validation_mode: str = "pandera"  # see VALIDATION_MODES & __validate_schema
+    validation_sample_size: PositiveInt = 10000  # rows, for validation_mode sampled
     _time_series_df_schema: pa.DataFrameSchema = PrivateAttr()
 
     class Config:  # Pydantic configuration
@@ -167,50 +420,145 @@ class TimeSeries(BaseModel):
 
     def __create_custom_df_schema(self):
         # At minimum will compare timestamp + value
+        numeric_dtype = float
+        if (
+            self.numeric_col_name in self.time_series_df
+            and self.time_series_df[self.numeric_col_name].dtype == np.float32
+        ):
+            numeric_dtype = pa.Float32  # compact ingest
         # Base dict
         self._time_series_df_schema = pa.DataFrameSchema(
             {
                 self.numeric_col_name: pa.Column(
-                    float, checks=pa.Check.greater_than_or_equal_to(0)
+                    numeric_dtype, checks=pa.Check.greater_than_or_equal_to(0)
                 )
             },
             index=Index(Timestamp, coerce=True),
         )
 
     def __data_clean_df(self):
-        """Clean the dataframe"""
+        """Clean the dataframe
 
+        One combined row mask & one sort, applied with a single take; the only
+        copy of the df. If nothing is dropped nor moved, the data is not copied."""
+
+        # drop row containing 0; correlating 0 with 0 is not interesting.
+        keep_rows = (self.time_series_df[self.numeric_col_name] != 0).to_numpy()
         # Remove missing rows
-        self.time_series_df = self.time_series_df.dropna()
-        # Sort index
-        self.time_series_df = self.time_series_df.sort_index(ascending=False)
+        for col_name in self.time_series_df.columns:
+            keep_rows &= self.time_series_df[col_name].notna().to_numpy()
+        row_positions = np.flatnonzero(keep_rows)
+        # Sort index DESC; like sort_index, keeps the order if already sorted
+        kept_index = self.time_series_df.index[row_positions]
+        if not kept_index.is_monotonic_decreasing:
+            _, sort_positions = kept_index.sort_values(
+                ascending=False, return_indexer=True
+            )
+            row_positions = row_positions[sort_positions]
+        if np.array_equal(row_positions, np.arange(len(self.time_series_df))):
+            # a new df object on the same data; the caller's df stays untouched
+            self.time_series_df = self.time_series_df.copy(deep=False)
+        else:
+            self.time_series_df = self.time_series_df.take(row_positions)
         # Validate time series & set
         self.__validate_ts_and_set_df()
 
     def drop_row_except(self, keep_list: tuple[Timestamp]):
-        """drop every row not within date range"""
-        self.time_series_df = self.time_series_df[
-            self.time_series_df.index.isin(keep_list)
-        ]
+        """drop every row not within date range
+
+        keep_list of consecutive days (eg. a longest sequence): compares integer
+        day positions from the first day instead of isin over Timestamps"""
+        index = self.time_series_df.index
+        keep_days = pd.DatetimeIndex(keep_list)
+        if (
+            isinstance(index, pd.DatetimeIndex)
+            and len(keep_days) > 0
+            and index.tz == keep_days.tz
+            and (np.diff(keep_days.asi8) == DAY_IN_NS).all()
+        ):
+            day_positions, time_of_day = np.divmod(
+                index.asi8 - keep_days.asi8[0], DAY_IN_NS
+            )
+            keep_rows = (
+                (time_of_day == 0)
+                & (day_positions >= 0)
+                & (day_positions < len(keep_days))
+            )
+        else:
+            keep_rows = index.isin(keep_list)
+        if not keep_rows.all():  # else keep the df as is, without a copy
+            self.time_series_df = self.time_series_df[keep_rows]
 
     def drop_col_except(self, keep_list: list[str]):
         """drop every col not within keep_list"""
         self.time_series_df = self.time_series_df.filter(keep_list)
 
-    def pivot_rows_to_cols(self, index, columns, values):
-        """converts a long df into a wide df"""
+    def pivot_rows_to_cols(self, index, columns, values, dtype=None):
+        """converts a long df into a wide df
+
+        dtype: eg. "float32" to halve the memory of the wide df; None keeps the dtype"""
         # CONTAINS SIDE EFFECTS! This method changes the representation.
         # Assumption: Methods are always used in the same sequence.
 
-        self.time_series_df = pd.pivot_table(
-            data=self.time_series_df,
-            index=index,
-            columns=columns,
-            values=values,
+        if dtype is not None:
+            # convert before pivoting; the pivot keeps the dtype of values
+            self.time_series_df = self.time_series_df.astype({values: dtype})
+
+        wide_df = pivot_without_aggregation(
+            self.time_series_df, index=index, columns=columns, values=values
         )
+        if wide_df is None:  # duplicates; aggregate them by mean
+            wide_df = pd.pivot_table(
+                data=self.time_series_df,
+                index=index,
+                columns=columns,
+                values=values,
+            )
+        self.time_series_df = wide_df
 
         self.time_series_df.dropna(axis=1, inplace=True)  # axis 1 means cols
 
+    def calc_longest_consecutive_days_sequences(
+        self,
+        windows: list[tuple[Timestamp, Timestamp]],
+        treshold: PositiveInt = 20,
+        provided_time_series_df: Optional[DataFrame] = None,
+    ) -> list[tuple[Timestamp]]:
+        """calculate the largest timeseries day sequence without gaps, per window
+
+        windows: (begin, end) timestamps, both inclusive; eg. one per target date
+        of a backfill. The day mask is built once and sliced per window.
+        output: per window the dates of its longest sequence in ASC order (the
+        newest on a tie), or an empty tuple if no date in it reaches the treshold"""
+
+        if provided_time_series_df is None:  # df not provided
+            provided_time_series_df = self.time_series_df
+
+        # count of values per date & filter based on threshold
+        date_counts = provided_time_series_df.index.value_counts()
+        dates_reaching_treshold = date_counts.index[date_counts >= treshold]
+        if len(dates_reaching_treshold) == 0:
+            return [tuple() for _ in windows]
+
+        # calendar including missing dates, True where a date reaches the treshold
+        calendar = pd.date_range(
+            start=dates_reaching_treshold.min(),
+            end=dates_reaching_treshold.max(),
+            freq="D",
+        )
+        day_mask = calendar.isin(dates_reaching_treshold)
+
+        longest_timestamp_ranges = []
+        for begin_timestamp, end_timestamp in windows:
+            begin_position = calendar.searchsorted(begin_timestamp, side="left")
+            end_position = calendar.searchsorted(end_timestamp, side="right")
+            run_start, run_length = longest_run(day_mask[begin_position:end_position])
+            run_start += begin_position
+            longest_timestamp_ranges.append(
+                tuple(calendar[run_start : run_start + run_length])
+            )
+        return longest_timestamp_ranges
+
     def calc_longest_consecutive_days_sequence(
         self,
         treshold: PositiveInt = 20,
@@ -222,87 +570,90 @@ class TimeSeries(BaseModel):
         Note: for stocks the treshold should be 1 because
         there is only one value per date"""
 
-        # group by day & count of group
         if provided_time_series_df is None:  # df not provided
-            grouped_dates_df = self.time_series_df
-        else:
-            grouped_dates_df = provided_time_series_df
-
-        grouped_dates_df = (
-            self.time_series_df.groupby(self.timestamp_index_name)
-            .size()
-            .to_frame("size")
-        )
-
-        # filter based on threshold
-        grouped_dates_df = grouped_dates_df[grouped_dates_df["size"] >= treshold]
-
-        # sort dates in asc order
-        grouped_dates_df = grouped_dates_df.sort_index(ascending=True)
-        print(grouped_dates_df)
-        # get start & end date of df
-        start_date = grouped_dates_df.index[0]
-        end_date = grouped_dates_df.index[-1]
-
-        # create date range to include missing dates
-
-        date_range_including_missing = pd.date_range(
-            start=start_date, end=end_date, freq="D"
+            provided_time_series_df = self.time_series_df
+        (longest_timestamp_range,) = self.calc_longest_consecutive_days_sequences(
+            windows=[
+                (
+                    provided_time_series_df.index.min(),
+                    provided_time_series_df.index.max(),
+                )
+            ],
+            treshold=treshold,
+            provided_time_series_df=provided_time_series_df,
         )
+        if not longest_timestamp_range:
+            raise ValueError(f"Expected a date with at least {treshold} values")
+        return longest_timestamp_range  # type:ignore
 
-        # add missing dates
-        grouped_dates_df = grouped_dates_df.reindex(date_range_including_missing, fill_value=0)  # type: ignore
-
-        # algo
-        # legend: x is a value > threshold
-        # leftwise is the oldest date, right is newest date
-        # x-xx-x
-        #      ^
-        # increase cur_seq_count by one
-        # save cur value to pd dataframe
-        # x-xx-x
-        #     ^
-        # reset cur_seq_count
-        # save cur value to pd dataframe
-
-        # sort by desc to itterows in reverse order
-        grouped_dates_df = grouped_dates_df.sort_index(ascending=False)
-
-        seq_count_col_name = "consecutive_days_sequence"
-
-        cur_seq_count = 0
-        for df_index, df_row in grouped_dates_df.iterrows():
-            if df_row[0] < treshold:
-                cur_seq_count = 0
+    def __validate_schema(self):
+        """Validate pandera df schema
+
+        validation_mode "pandera": the full schema, coerces the index
+        validation_mode "numpy": the same checks vectorized, without a copy
+        validation_mode "sampled": the full schema on validation_sample_size rows
+        Both fast modes coerce the index to timestamps and check all of it, as
+        pandera would: a NaT would become a wrong cell in pivot_rows_to_cols."""
+        validation_start_time = perf_counter()
+        time_series_df_schema = self._time_series_df_schema
+        if self.validation_mode == "pandera":
+            # inplace; the df is already our own (see __data_clean_df)
+            self.time_series_df = time_series_df_schema(
+                self.time_series_df, inplace=True
+            )
+        elif self.validation_mode in VALIDATION_MODES:
+            self.__validate_index()
+            if self.validation_mode == "numpy":
+                self.__validate_numpy()
             else:
-                cur_seq_count += 1
-            grouped_dates_df.loc[df_index, seq_count_col_name] = cur_seq_count
-
-        # reset index
-        grouped_dates_df.reset_index(inplace=True)  # maintains sorting
-        # CLUDGE: Timestamp was renamed to index! Bring it back.
-        grouped_dates_df = grouped_dates_df.rename(
-            columns={"index": self.timestamp_index_name}
-        )
-
-        max_seq_start_date_index = grouped_dates_df[seq_count_col_name].idxmax()
-        max_seq_value = int(
-            grouped_dates_df[seq_count_col_name].iloc[max_seq_start_date_index]
+                time_series_df_schema(
+                    self.time_series_df.sample(
+                        n=min(self.validation_sample_size, len(self.time_series_df)),
+                        random_state=0,
+                    )
+                )
+        else:
+            raise ValueError(f"validation_mode should be one of {VALIDATION_MODES}")
+        print(
+            f"{self.validation_mode} validation of {len(self.time_series_df)} rows"
+            f" in seconds: {perf_counter() - validation_start_time}"
         )
 
-        longest_timestamp_range = [
-            grouped_dates_df[self.timestamp_index_name].iloc[
-                max_seq_start_date_index - offset_from_max_seq_start_date_index
-            ]
-            for offset_from_max_seq_start_date_index in range(max_seq_value)
-        ]
-
-        return tuple(longest_timestamp_range)  # type:ignore
+    def __validate_index(self):
+        """the checks of _time_series_df_schema on the index: coerced to
+        timestamps & not null"""
+        schema_error_message = None
+        if not isinstance(self.time_series_df.index, pd.DatetimeIndex):
+            try:
+                self.time_series_df.index = pd.to_datetime(self.time_series_df.index)
+            except (TypeError, ValueError) as coerce_error:
+                schema_error_message = f"cannot coerce to timestamps: {coerce_error}"
+        if schema_error_message is None and self.time_series_df.index.hasnans:
+            schema_error_message = "null values"
+        if schema_error_message is not None:
+            raise SchemaError(
+                self._time_series_df_schema,
+                self.time_series_df,
+                f"index: {schema_error_message}",
+            )
 
-    def __validate_schema(self):
-        """Validate pandera df schema"""
-        time_series_df_schema = self._time_series_df_schema
-        self.time_series_df = time_series_df_schema(self.time_series_df)
+    def __validate_numpy(self):
+        """the checks of _time_series_df_schema on the numeric col: float, not
+        null & >= 0"""
+        numeric_np_array = self.time_series_df[self.numeric_col_name].to_numpy()
+        schema_error_message = None
+        if not np.issubdtype(numeric_np_array.dtype, np.floating):
+            schema_error_message = f"expected float, got {numeric_np_array.dtype}"
+        elif np.isnan(numeric_np_array).any():
+            schema_error_message = "null values"
+        elif (numeric_np_array < 0).any():
+            schema_error_message = "values below 0"
+        if schema_error_message is not None:
+            raise SchemaError(
+                self._time_series_df_schema,
+                self.time_series_df,
+                f"{self.numeric_col_name}: {schema_error_message}",
+            )
 
     def __validate_ts_and_set_df(self):
         """Validate time series dataframe and set
@@ -320,10 +671,9 @@ class TimeSeries(BaseModel):
         super().__init__(*args, **kwargs)
         if self.time_series_df.empty:
             raise ValueError("Expected non-empty DataFrame")
-        # drop row containing 0; correlating 0 with 0 is not interesting.
-        self.time_series_df = self.time_series_df[
-            self.time_series_df[self.numeric_col_name] != 0
-        ]
+        if self.is_pivoted:  # the long format cleaning does not apply
+            self.__create_custom_df_schema()
+            return
         self.__create_custom_df_schema()
         self.__data_clean_df()
 
@@ -388,6 +738,73 @@ class StockTimeSeries(TimeSeries):
         start_series = self.time_series_df.iloc[start_date_index]
         end_series = self.time_series_df.iloc[end_date_index]
 
+        return self._rank_moves(start_series, end_series, max_stocks_output)
+
+    def find_movers_and_shakers_long(
+        self,
+        start_date: Timestamp,
+        end_date: Timestamp,
+        symbol_col_name: str = "stock_symbol",
+        min_stocks_output=60,  # see find_movers_and_shakers
+        max_stocks_output=60,
+    ) -> tuple[tuple[str, float]]:
+        """find_movers_and_shakers on the long df, before pivot_rows_to_cols
+
+        Only the symbols with a value on every day of the df count, as after the
+        dropna of pivot_rows_to_cols; duplicate rows are averaged, as pivot_table
+        does. Then only the selected symbols need pivoting (see
+        drop_symbol_rows_except).
+
+        output: ((stock_symbol_str, percentage_move_in_float))"""
+        if min_stocks_output > max_stocks_output:
+            raise ValueError(
+                "arg min_stocks_output cannot be bigger than max_stocks_output"
+            )
+
+        day_codes, days = pd.factorize(self.time_series_df.index)
+        symbol_codes, symbols = pd.factorize(
+            self.time_series_df[symbol_col_name], sort=True
+        )
+        symbols = np.asarray(symbols)  # a categorical col has categorical uniques
+        values = self.time_series_df[self.numeric_col_name].to_numpy()
+
+        # complete symbols: a row on every day
+        symbol_days = np.unique(symbol_codes * len(days) + day_codes)
+        is_complete = np.bincount(
+            symbol_days // len(days), minlength=len(symbols)
+        ) == len(days)
+        if is_complete.sum() < min_stocks_output:
+            raise ValueError("Not enough stocks in df")
+
+        def mean_per_symbol(date: Timestamp) -> np.ndarray:
+            """NaN for a symbol without a row on the date (0 / 0)"""
+            on_date = day_codes == days.get_loc(date)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return np.bincount(
+                    symbol_codes[on_date],
+                    weights=values[on_date],
+                    minlength=len(symbols),
+                ) / np.bincount(symbol_codes[on_date], minlength=len(symbols))
+
+        start_series = pd.Series(mean_per_symbol(start_date), index=symbols)
+        end_series = pd.Series(mean_per_symbol(end_date), index=symbols)
+        return self._rank_moves(
+            start_series[is_complete], end_series[is_complete], max_stocks_output
+        )
+
+    def drop_symbol_rows_except(
+        self, keep_list: list[str], symbol_col_name: str = "stock_symbol"
+    ):
+        """drop the rows of every symbol not within keep_list, on the long df"""
+        self.time_series_df = self.time_series_df[
+            self.time_series_df[symbol_col_name].isin(keep_list)
+        ]
+
+    @staticmethod
+    def _rank_moves(
+        start_series: pd.Series, end_series: pd.Series, max_stocks_output
+    ) -> tuple[tuple[str, float]]:
+        """the largest relative moves from start_series to end_series, per symbol"""
         # normalize based on start_series to find biggest % increase
 
         end_series = end_series.div(  # type: ignore
@@ -415,3 +832,204 @@ class StockTimeSeries(TimeSeries):
         # tuple_list = tuple(abs_delta_df.reset_index().values.tolist())
 
         return tuples_stock_and_rel_change
+
+
+class PrecipitationCube(BaseModel):
+    """dense days x grid points store of one numeric col, memory mapped
+
+    Files in cube_folder (see ingress.build_precipitation_cube):
+    values.npy: days x grid points, C order; a window of days is one contiguous slice
+    dates.npy: the day of every row, ascending
+    grid.npy: the uid cols (eg. latitude, longitude) of every grid point, sorted
+    meta.json: the names of the uid cols"""
+
+    cube_folder: Path
+    _values: np.ndarray = PrivateAttr()
+    _dates: np.ndarray = PrivateAttr()
+    _grid_index: pd.MultiIndex = PrivateAttr()
+
+    class Config:  # Pydantic configuration
+        arbitrary_types_allowed = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = np.load(self.cube_folder / "values.npy", mmap_mode="r")
+        self._dates = np.load(self.cube_folder / "dates.npy")
+        uid_col_names = json.loads((self.cube_folder / "meta.json").read_text())[
+            "uid_col_names"
+        ]
+        self._grid_index = pd.MultiIndex.from_arrays(
+            list(np.load(self.cube_folder / "grid.npy").T), names=uid_col_names
+        )
+
+    @staticmethod
+    def create(cube_folder: Path, dates, grid_df: DataFrame, dtype="float32"):
+        """write the date & grid index of a new cube
+
+        grid_df: one row per grid point, the uid cols as cols, sorted
+        output: the values as writable memmap (days x grid points) filled with NaN"""
+        cube_folder.mkdir(parents=True, exist_ok=True)
+        np.save(cube_folder / "dates.npy", np.asarray(dates, dtype="datetime64[D]"))
+        np.save(cube_folder / "grid.npy", grid_df.to_numpy(dtype=np.float64))
+        (cube_folder / "meta.json").write_text(
+            json.dumps({"uid_col_names": list(grid_df.columns)})
+        )
+        values = np.lib.format.open_memmap(
+            cube_folder / "values.npy",
+            mode="w+",
+            dtype=dtype,
+            shape=(len(dates), len(grid_df)),
+        )
+        values[:] = np.nan
+        return values
+
+    def window(
+        self,
+        begin_timestamp: datetime,
+        end_timestamp: datetime,
+        drop_incomplete_cols: bool = True,
+    ) -> DataFrame:
+        """wide df (timestamp x grid points) of the days begin until end, included
+
+        The values are a view on the memory map, not a copy. drop_incomplete_cols
+        drops the grid points with a missing or 0 value within the window, as
+        TimeSeries & pivot_rows_to_cols do; selecting the cols copies, unless
+        every col is complete."""
+        begin_day, end_day = (
+            np.datetime64(pd.Timestamp(timestamp).date(), "D")
+            for timestamp in (begin_timestamp, end_timestamp)
+        )
+        row_begin = np.searchsorted(self._dates, begin_day, side="left")
+        row_end = np.searchsorted(self._dates, end_day, side="right")
+        values = np.asarray(self._values[row_begin:row_end])
+        df = pd.DataFrame(
+            values,
+            index=pd.DatetimeIndex(self._dates[row_begin:row_end], name="timestamp"),
+            columns=self._grid_index,
+            copy=False,
+        )
+        if drop_incomplete_cols:
+            complete_cols = ~(np.isnan(values) | (values == 0)).any(axis=0)
+            if not complete_cols.all():
+                df = df.loc[:, complete_cols]
+        return df
+
+
+class TradingCalendar(BaseModel):
+    """per day symbol count of the stock table & its runs of trading days, on disk
+
+    A run is a sequence of consecutive days with at least treshold symbols each;
+    what calc_longest_consecutive_days_sequence recomputes for every target date.
+    Files in calendar_folder (see ingress.build_trading_calendar):
+    symbol_counts.npy: symbols per day from first_day on; 0 for a day without rows
+    run_bounds.npy: per day the day positions (first, last) of the run containing
+    it, (-1, -1) for a day below the treshold
+    runs.npy: (first, last) day position of every run, ascending
+    meta.json: first_day & treshold
+    Rebuild it when the stock table changes."""
+
+    calendar_folder: Path
+    _first_day: np.datetime64 = PrivateAttr()
+    _treshold: int = PrivateAttr()
+    _symbol_counts: np.ndarray = PrivateAttr()
+    _run_bounds: np.ndarray = PrivateAttr()
+    _runs: np.ndarray = PrivateAttr()
+
+    class Config:  # Pydantic configuration
+        arbitrary_types_allowed = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        meta = json.loads((self.calendar_folder / "meta.json").read_text())
+        self._first_day = np.datetime64(meta["first_day"], "D")
+        self._treshold = meta["treshold"]
+        self._symbol_counts = np.load(self.calendar_folder / "symbol_counts.npy")
+        self._run_bounds = np.load(self.calendar_folder / "run_bounds.npy")
+        self._runs = np.load(self.calendar_folder / "runs.npy")
+
+    @staticmethod
+    def create(calendar_folder: Path, dates, symbol_counts, treshold: PositiveInt = 20):
+        """write the calendar of the per date symbol counts (eg. count(*) GROUP BY
+        timestamp); dates without a count have 0 symbols"""
+        days = np.asarray(pd.DatetimeIndex(dates).normalize(), dtype="datetime64[D]")
+        first_day = days.min()
+        day_positions = (days - first_day).astype(np.int64)
+        day_symbol_counts = np.zeros(day_positions.max() + 1, dtype=np.int64)
+        np.add.at(day_symbol_counts, day_positions, np.asarray(symbol_counts))
+
+        # run-length over the days reaching the treshold, as longest_run
+        in_run = day_symbol_counts >= treshold
+        edges = np.diff(np.concatenate(([0], in_run.astype(np.int8), [0])))
+        runs = np.column_stack(
+            (np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1)
+        )
+        run_bounds = np.full((len(day_symbol_counts), 2), -1, dtype=np.int64)
+        run_bounds[in_run] = np.repeat(runs, runs[:, 1] - runs[:, 0] + 1, axis=0)
+
+        calendar_folder.mkdir(parents=True, exist_ok=True)
+        np.save(calendar_folder / "symbol_counts.npy", day_symbol_counts)
+        np.save(calendar_folder / "run_bounds.npy", run_bounds)
+        np.save(calendar_folder / "runs.npy", runs)
+        (calendar_folder / "meta.json").write_text(
+            json.dumps({"first_day": str(first_day), "treshold": int(treshold)})
+        )
+        return TradingCalendar(calendar_folder=calendar_folder)
+
+    def _day_position(self, timestamp: datetime) -> int:
+        day = np.datetime64(pd.Timestamp(timestamp).date(), "D")
+        return int((day - self._first_day).astype(np.int64))
+
+    def symbol_count(self, timestamp: datetime) -> int:
+        """symbols on the day of timestamp"""
+        day_position = self._day_position(timestamp)
+        if 0 <= day_position < len(self._symbol_counts):
+            return int(self._symbol_counts[day_position])
+        return 0
+
+    def longest_sequence(
+        self, begin_timestamp: datetime, end_timestamp: datetime
+    ) -> tuple[Timestamp]:
+        """the days of the longest run within begin until end, included; as
+        TimeSeries.calc_longest_consecutive_days_sequence with the treshold of the
+        calendar: ASC, the newest run on a tie, empty if no day reaches it
+
+        Lookups instead of a scan of the days: the runs containing begin & end
+        (clipped to the window) and the runs in between, found by searchsorted."""
+        begin_position = max(self._day_position(begin_timestamp), 0)
+        end_position = min(
+            self._day_position(end_timestamp), len(self._symbol_counts) - 1
+        )
+        if begin_position > end_position:
+            return tuple()
+
+        # newest first, so that the first longest candidate wins the tie
+        candidates = []
+        end_run_first, _ = self._run_bounds[end_position]
+        if end_run_first != -1:
+            candidates.append((max(end_run_first, begin_position), end_position))
+        inner_runs = self._runs[
+            np.searchsorted(self._runs[:, 0], begin_position, side="left") : (
+                np.searchsorted(self._runs[:, 1], end_position, side="left")
+            )
+        ]
+        candidates.extend(
+            (run_first, run_last)
+            for run_first, run_last in inner_runs[::-1]
+            if run_first != end_run_first
+        )
+        begin_run_first, begin_run_last = self._run_bounds[begin_position]
+        if begin_run_first != -1 and begin_run_first != end_run_first:
+            candidates.append((begin_position, min(begin_run_last, end_position)))
+        if not candidates:
+            return tuple()
+
+        run_first, run_last = max(
+            candidates, key=lambda candidate: candidate[1] - candidate[0]
+        )
+        return tuple(
+            pd.date_range(
+                start=pd.Timestamp(self._first_day + run_first),
+                periods=run_last - run_first + 1,
+                freq="D",
+            )
+        )
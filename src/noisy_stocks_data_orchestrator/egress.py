@@ -36,6 +36,7 @@ def visualize_corr(
     dataset_uid,
     latitude,
     longitude,
+    corr_method="pearson",
 ):
     # TODO: This is encapsulation hell; I ran out of time, but it was a fun project!
     # TODO: refactor, export graph in other function
@@ -48,7 +49,9 @@ def visualize_corr(
     country_code = results[0]["cc"]
     pd.options.plotting.backend = "plotly"
     # sanity check, are the corrs correct?
-    assert highest_corr == approx(pd_series_stocks.corr(pd_series_dataset))
+    assert highest_corr == approx(
+        pd_series_stocks.corr(pd_series_dataset, method=corr_method)
+    )
     df1 = pd.DataFrame(pd_series_stocks)
     df2 = pd.DataFrame(pd_series_dataset)
     # convert timestamp to datetime
@@ -175,6 +178,9 @@ def corr_to_db_content(
         "dataset_uid_col_name_list",
         "dataset_uid",
         "requested_publish_date",
+        "p_value",
+        "family_p_value",
+        "corr_method",
     ],
     corr_dict_pickle_folder_path: Path = Path(
         r"/home/kevin/coding_projects/noisy_stocks/persistent_data/corr_dicts/"
@@ -226,6 +232,8 @@ def corr_to_db_content(
                 dataset_uid=corr_dict[stock_symbol]["dataset_uid"],
                 longitude=unfolded_indexes["longitude"],
                 latitude=unfolded_indexes["latitude"],
+                # corr_dicts pickled before spearman existed are pearson
+                corr_method=corr_dict[stock_symbol].get("corr_method", "pearson"),
             )
 
             file_hash = hash_file(filepath=corr_dict_file_path, algo_name="sha256")
@@ -1,15 +1,33 @@
+import hashlib
+import os
 import pickle
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
 from pathlib import Path
+from tempfile import SpooledTemporaryFile
+from typing import Optional
 
+import numpy as np
 import pandas as pd
+import pyarrow.feather as feather
 from pandas import DataFrame
 from prefect.flows import flow
 from prefect.task_runners import SequentialTaskRunner
 from prefect.tasks import task
 from pydantic import validate_arguments
-from sqlalchemy import engine
+from sqlalchemy import create_engine, engine, text
 
-from customdatastructures import StockTimeSeries, TimeSeries, file_exists
+from customdatastructures import (
+    CorrDatabaseQuery,
+    PrecipitationCube,
+    StockTimeSeries,
+    TimeSeries,
+    TradingCalendar,
+    file_exists,
+)
 
 """Data Inflow Module for data from database
 """
@@ -22,6 +40,79 @@ class Config_Arbitrary_Types_Allowed:
     arbitrary_types_allowed = True
 
 
+# BUG: Not a pydantic BaseModel on purpose; Prefect rebuilds models passed as flow
+# parameters, so the hit & miss counters of the caller would stay 0.
+class QueryResultCache:
+    """local cache of query results, one uncompressed Arrow (feather) file each
+
+    A result is keyed by a hash of the database url, the sql and data_version;
+    bump data_version to invalidate everything after the source data changed.
+    A hit is memory mapped; split_blocks keeps null free numeric cols zero-copy
+    (read-only) views of the file, other cols are converted into new memory. The
+    mapping outlives the file: put replaces & evict unlinks it, which on POSIX
+    leaves an earlier hit valid (on Windows a mapped file cannot be removed).
+    When the folder exceeds max_size_in_bytes the least recently used files are
+    evicted."""
+
+    def __init__(
+        self,
+        cache_folder: Path,
+        max_size_in_bytes: int = 2**30,  # 1 GiB
+        data_version: str = "",
+    ):
+        self.cache_folder = Path(cache_folder)
+        self.max_size_in_bytes = max_size_in_bytes
+        self.data_version = data_version
+        self.hits = 0
+        self.misses = 0
+
+    def _cache_path(self, sql_alchemy_engine, query) -> Path:
+        if isinstance(query, list):  # partition queries
+            query = "\n".join(query)
+        key = "\n".join(
+            (
+                sql_alchemy_engine.url.render_as_string(hide_password=True),
+                query,
+                self.data_version,
+            )
+        )
+        return self.cache_folder / (hashlib.sha256(key.encode()).hexdigest() + ".arrow")
+
+    def get(self, sql_alchemy_engine, query) -> Optional[DataFrame]:
+        """cached result of the query or None; counts the hit or miss"""
+        cache_path = self._cache_path(sql_alchemy_engine, query)
+        if not cache_path.is_file():
+            self.misses += 1
+            return None
+        self.hits += 1
+        os.utime(cache_path)  # most recently used
+        return feather.read_table(cache_path, memory_map=True).to_pandas(
+            split_blocks=True
+        )
+
+    def put(self, sql_alchemy_engine, query, df: DataFrame):
+        """store the result of the query, then evict down to max_size_in_bytes"""
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+        cache_path = self._cache_path(sql_alchemy_engine, query)
+        # write aside & rename, so a reader never sees half a file
+        temporary_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        feather.write_feather(df, temporary_path, compression="uncompressed")
+        temporary_path.replace(cache_path)
+        self.evict()
+
+    def evict(self):
+        """remove the least recently used files until within max_size_in_bytes"""
+        cache_paths = sorted(
+            self.cache_folder.glob("*.arrow"), key=lambda path: path.stat().st_mtime
+        )
+        cache_size = sum(path.stat().st_size for path in cache_paths)
+        for cache_path in cache_paths:
+            if cache_size <= self.max_size_in_bytes:
+                break
+            cache_size -= cache_path.stat().st_size
+            cache_path.unlink()
+
+
 @flow(task_runner=SequentialTaskRunner())
 def load_object_from_file_path(file_path: Path):
     """input: object, folderPath, the filename will be the current datetime"""
@@ -44,16 +135,115 @@ def fetch_stocks_to_TimeSeries(*args, **kwargs):
 
 
 @flow(task_runner=SequentialTaskRunner())
-def fetch_weather_to_TimeSeries(*args, **kwargs):
+def fetch_weather_to_TimeSeries(
+    *args, cube_folder=None, begin_timestamp=None, end_timestamp=None, **kwargs
+):
     """thin wrapper for query_database_to_TimeSeries for two reasons:
     1. to apply weather specific settings
-    2. to differentiate the flows"""
+    2. to differentiate the flows
+
+    cube_folder: read the days begin_timestamp until end_timestamp from a
+    PrecipitationCube instead; already wide, no sql, no pivot, no copy"""
+    if cube_folder is not None:
+        return TimeSeries(
+            timestamp_index_name=kwargs.get("timestamp_index_name", "timestamp"),
+            numeric_col_name=kwargs["numeric_col_name"],
+            time_series_df=PrecipitationCube(cube_folder=cube_folder).window(
+                begin_timestamp, end_timestamp
+            ),
+            is_pivoted=True,
+        )
+
     # query weather
     time_series = query_database_to_TimeSeries(*args, **kwargs)
 
     return time_series
 
 
+@flow(task_runner=SequentialTaskRunner())
+def build_precipitation_cube(
+    sql_alchemy_engine,
+    cube_folder: Path,
+    begin_date: datetime,
+    end_date: datetime,
+    uid_col_names=["latitude", "longitude"],
+    numeric_col_name: str = "precipitation",
+    database_name: str = "weather",
+    dtype: str = "float32",
+    days_per_partition: int = 30,
+):
+    """build a PrecipitationCube of the days begin_date until end_date, included
+
+    Reads days_per_partition days at a time and scatters the long rows straight
+    into the memory mapped values; days without a row stay NaN."""
+    grid_df = query_database(
+        sql_alchemy_engine=sql_alchemy_engine,
+        query=f"SELECT DISTINCT {','.join(uid_col_names)} FROM {database_name};",
+    ).sort_values(uid_col_names, ignore_index=True)
+    dates = pd.date_range(begin_date.date(), end_date.date(), freq="D")
+    values = PrecipitationCube.create(
+        cube_folder=cube_folder, dates=dates, grid_df=grid_df, dtype=dtype
+    )
+    grid_index = pd.MultiIndex.from_frame(grid_df)
+
+    query_object = CorrDatabaseQuery(
+        select_fields=["timestamp", *uid_col_names, numeric_col_name],
+        from_database=database_name,
+        process_begin_and_end_timestamp=(begin_date, end_date),
+    )
+    for partition_query in query_object.to_sql_partitions(
+        days_per_partition=days_per_partition
+    ):
+        partition_df = query_database(
+            sql_alchemy_engine=sql_alchemy_engine, query=partition_query
+        )
+        days = pd.to_datetime(partition_df["timestamp"], utc=True).dt.tz_localize(None)
+        rows = dates.get_indexer(days.dt.normalize())
+        cols = grid_index.get_indexer(
+            pd.MultiIndex.from_frame(partition_df[uid_col_names])
+        )
+        # -1: a day or grid point outside the cube, eg. added after the grid query
+        in_cube = (rows >= 0) & (cols >= 0)
+        if not in_cube.all():
+            print(f"skipped {np.count_nonzero(~in_cube)} rows outside the cube")
+        values[rows[in_cube], cols[in_cube]] = partition_df[
+            numeric_col_name
+        ].to_numpy()[in_cube]
+    values.flush()
+    print(f"cube of {values.shape[0]} days x {values.shape[1]} grid points")
+    return cube_folder
+
+
+@flow(task_runner=SequentialTaskRunner())
+def build_trading_calendar(
+    sql_alchemy_engine,
+    calendar_folder: Path,
+    treshold: int = 20,
+    numeric_col_name: str = "price_close",
+    database_name: str = "stock_timedata",
+):
+    """build the TradingCalendar of the stock table, once for every target date
+
+    Counts the rows per timestamp in sql, leaving out NULL & 0 values as
+    TimeSeries does."""
+    counts_df = query_database(
+        sql_alchemy_engine=sql_alchemy_engine,
+        query=(
+            f"SELECT timestamp, count(*) AS symbol_count FROM {database_name}"
+            f" WHERE {numeric_col_name} IS NOT NULL AND {numeric_col_name} != 0"
+            " GROUP BY timestamp;"
+        ),
+    )
+    TradingCalendar.create(
+        calendar_folder=calendar_folder,
+        dates=pd.to_datetime(counts_df["timestamp"], utc=True).dt.tz_localize(None),
+        symbol_counts=counts_df["symbol_count"].to_numpy(),
+        treshold=treshold,
+    )
+    print(f"trading calendar of {len(counts_df)} dates")
+    return calendar_folder
+
+
 @validate_arguments(config=Config_Arbitrary_Types_Allowed)
 @task(retries=5, retry_delay_seconds=3)
 def query_database(sql_alchemy_engine: engine.base.Engine, query: str) -> DataFrame:
@@ -62,6 +252,217 @@ def query_database(sql_alchemy_engine: engine.base.Engine, query: str) -> DataFr
     # SPEED, major: parallelize read into sql
 
 
+@validate_arguments(config=Config_Arbitrary_Types_Allowed)
+@task(retries=5, retry_delay_seconds=3)
+def query_database_partitions(
+    sql_alchemy_engine: engine.base.Engine, queries: list[str], max_workers: int = 4
+) -> DataFrame:
+    """run the partition queries (eg. CorrDatabaseQuery.to_sql_partitions)
+    concurrently on at most max_workers connections of the engine pool
+
+    output: one DataFrame, the partitions in order of the queries"""
+
+    def read_partition(query: str) -> DataFrame:
+        with sql_alchemy_engine.connect() as connection:
+            return pd.read_sql(query, connection)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        partition_dfs = list(executor.map(read_partition, queries))
+    # one concat at the end; appending per partition would copy every time
+    return pd.concat(partition_dfs, ignore_index=True, copy=False)
+
+
+def _col_chunk(values, col_kind: str) -> np.ndarray:
+    """one batch of a streamed col as a numpy array; NULL becomes NaN/NaT/None
+
+    col_kind: "timestamp", "numeric" (float64, so NULL fits as NaN) or object"""
+    if col_kind == "timestamp":
+        return pd.to_datetime(values, utc=True).tz_localize(None).to_numpy()
+    if col_kind == "numeric":
+        return np.array(values, dtype=np.float64)
+    return np.array(values, dtype=object)
+
+
+def _null_chunk(row_count: int, col_kind: Optional[str]) -> np.ndarray:
+    """row_count NULL values of a streamed col, of col_kind"""
+    if col_kind == "timestamp":
+        return np.full(row_count, np.datetime64("NaT"), dtype="datetime64[ns]")
+    if col_kind == "numeric":
+        return np.full(row_count, np.nan)
+    return np.full(row_count, None, dtype=object)
+
+
+def _compact_chunk(chunk: np.ndarray, compact_dtype: Optional[str]):
+    """one chunk of a streamed col in its compact dtype (see compact_dtypes)"""
+    if compact_dtype == "float32":
+        return chunk.astype(np.float32)
+    if compact_dtype == "category":
+        return pd.Categorical(chunk)
+    return chunk
+
+
+def _join_categorical_chunks(chunks: list) -> pd.Categorical:
+    """one Categorical of the chunks, its categories sorted as astype("category");
+    the chunks are recoded to the union of their categories, then only the codes
+    are joined"""
+    categories = pd.Index(
+        np.unique(np.concatenate([chunk.categories.to_numpy() for chunk in chunks]))
+    )
+    return pd.Categorical.from_codes(
+        np.concatenate([chunk.set_categories(categories).codes for chunk in chunks]),
+        categories=categories,
+    )
+
+
+@validate_arguments(config=Config_Arbitrary_Types_Allowed)
+@task(retries=5, retry_delay_seconds=3)
+def stream_query_database(
+    sql_alchemy_engine: engine.base.Engine,
+    query: str,
+    fetch_size: int = 10000,
+    timestamp_col_name: str = "timestamp",
+    compact_numeric_col_name: Optional[str] = None,
+) -> DataFrame:
+    """like query_database, but streams the rows from a server side cursor
+
+    One pass: fetches fetch_size rows per round trip and converts every batch
+    into a numpy chunk per col; only one batch is ever held as Python objects.
+    The chunks are joined one col at a time, releasing that col's chunks, and the
+    cols become the DataFrame without another copy; peak memory stays close to
+    the result plus its largest col. Decimal (NUMERIC) cols become float64, like
+    read_sql(coerce_float=True); the timestamp col is returned as UTC.
+    compact_numeric_col_name: the dtypes of compact_dtypes per batch, so the
+    float64 & object cols never exist in full; that col float32, every other
+    col but the timestamp categorical.
+    output: DataFrame with the cols of the query"""
+    with sql_alchemy_engine.connect() as connection:
+        # stream_results: named (server side) cursor for psycopg2
+        result = connection.execution_options(
+            stream_results=True, max_row_buffer=fetch_size
+        ).execute(text(query.strip().rstrip(";")))
+        col_names = list(result.keys())
+        col_kinds = dict.fromkeys(col_names)  # None while every value is NULL
+        compact_dtypes_by_col = dict.fromkeys(col_names)
+        if compact_numeric_col_name is not None:
+            compact_dtypes_by_col.update(
+                {
+                    col_name: "float32"
+                    if col_name == compact_numeric_col_name
+                    else "category"
+                    for col_name in col_names
+                    if col_name != timestamp_col_name
+                }
+            )
+        col_chunks = {col_name: [] for col_name in col_names}
+        for rows in result.partitions(fetch_size):
+            for col_name, values in zip(col_names, zip(*rows)):
+                if col_kinds[col_name] is None:
+                    non_null_values = [value for value in values if value is not None]
+                    if not non_null_values:
+                        col_chunks[col_name].append(len(values))  # NULL rows
+                        continue
+                    if col_name == timestamp_col_name:
+                        col_kinds[col_name] = "timestamp"
+                    elif isinstance(non_null_values[0], Decimal) or (
+                        np.asarray(non_null_values).dtype.kind in "biuf"
+                    ):
+                        col_kinds[col_name] = "numeric"
+                    else:
+                        col_kinds[col_name] = "object"
+                col_chunks[col_name].append(
+                    _compact_chunk(
+                        _col_chunk(values, col_kinds[col_name]),
+                        compact_dtypes_by_col[col_name],
+                    )
+                )
+
+    col_arrays = {}
+    for col_name in col_names:
+        # pop: the chunks of a col are released as soon as it is joined
+        compact_dtype = compact_dtypes_by_col[col_name]
+        chunks = [
+            _compact_chunk(_null_chunk(chunk, col_kinds[col_name]), compact_dtype)
+            if isinstance(chunk, int)
+            else chunk
+            for chunk in col_chunks.pop(col_name)
+        ] or [_compact_chunk(_null_chunk(0, col_kinds[col_name]), compact_dtype)]
+        if compact_dtype == "category":
+            col_arrays[col_name] = _join_categorical_chunks(chunks)
+        else:
+            col_arrays[col_name] = np.concatenate(chunks)
+        del chunks
+        if col_kinds[col_name] == "timestamp":
+            # the UTC nanoseconds as tz aware, on the same memory
+            col_arrays[col_name] = pd.arrays.DatetimeArray(
+                col_arrays[col_name], dtype=pd.DatetimeTZDtype(tz="UTC")
+            )
+    # copy=False: one block per col, not consolidated into a copy; no columns=
+    # arg, which would reindex (copy) the cols, the dict keeps their order
+    return DataFrame(col_arrays, copy=False)
+
+
+def parse_copy_csv(
+    csv_buffer,
+    timestamp_col_name: str = "timestamp",
+    compact_numeric_col_name: Optional[str] = None,
+) -> DataFrame:
+    """parse the CSV output of COPY ... TO STDOUT (with header) in one pass
+
+    COPY writes NULL as an empty unquoted field; only that is NaN, unlike the
+    default NA strings of pandas (eg. "NA", "NULL", "nan" stay text, as with
+    read_sql). The timestamp col is returned as UTC
+    compact_numeric_col_name: parse into the dtypes of compact_dtypes; that col
+    float32, every other col but the timestamp categorical"""
+    dtype = None
+    if compact_numeric_col_name is not None:
+        dtype = defaultdict(
+            lambda: "category",
+            {compact_numeric_col_name: "float32", timestamp_col_name: "object"},
+        )
+    df = pd.read_csv(csv_buffer, keep_default_na=False, na_values=[""], dtype=dtype)
+    if timestamp_col_name in df:
+        df[timestamp_col_name] = pd.to_datetime(df[timestamp_col_name], utc=True)
+    return df
+
+
+@validate_arguments(config=Config_Arbitrary_Types_Allowed)
+@task(retries=5, retry_delay_seconds=3)
+def copy_query_database(
+    sql_alchemy_engine: engine.base.Engine,
+    query: str,
+    timestamp_col_name: str = "timestamp",
+    spool_size_in_bytes: int = 2**24,  # 16 MiB
+    compact_numeric_col_name: Optional[str] = None,  # see parse_copy_csv
+) -> DataFrame:
+    """like query_database, but Postgres/Timescale sends the result with
+    COPY (query) TO STDOUT as CSV, which pandas parses vectorized instead of
+    building every row as Python objects
+
+    The CSV is spooled: in memory up to spool_size_in_bytes, beyond that in a
+    temporary file, so the CSV text does not double the peak memory of a large
+    read"""
+    subquery = query.strip().rstrip(";")
+    raw_connection = sql_alchemy_engine.raw_connection()
+    with SpooledTemporaryFile(max_size=spool_size_in_bytes) as csv_file:
+        try:
+            cursor = raw_connection.cursor()
+            if not hasattr(cursor, "copy_expert"):
+                raise ValueError("COPY needs a Postgres (psycopg2) connection")
+            cursor.copy_expert(
+                f"COPY ({subquery}) TO STDOUT WITH (FORMAT csv, HEADER true)",
+                csv_file,
+            )
+            cursor.close()
+        finally:
+            raw_connection.close()
+        csv_file.seek(0)
+        return parse_copy_csv(
+            csv_file,
+            timestamp_col_name=timestamp_col_name,
+            compact_numeric_col_name=compact_numeric_col_name,
+        )
+
+
 @validate_arguments(config=Config_Arbitrary_Types_Allowed)
 @task(retries=5, retry_delay_seconds=5)
 def normalize_timestamp(df: DataFrame) -> DataFrame:
@@ -75,6 +476,36 @@ def normalize_timestamp(df: DataFrame) -> DataFrame:
     return df
 
 
+@validate_arguments(config=Config_Arbitrary_Types_Allowed)
+@task(retries=5, retry_delay_seconds=5)
+def compact_dtypes(df: DataFrame, numeric_col_name: str) -> DataFrame:
+    """float32 measurements & categorical keys (eg. stock_symbol, latitude);
+    prints the memory saved. The timestamp index stays a DatetimeIndex, which
+    the TimeSeries methods & schema rely on.
+
+    Only the cols not yet compact are converted; the stream & COPY reads are
+    compact already (see compact_numeric_col_name), read_sql & partition reads
+    are converted here, after the full frame existed."""
+    memory_before = df.memory_usage(deep=True).sum()
+    compact_dtypes_by_col = {
+        col_name: "float32" if col_name == numeric_col_name else "category"
+        for col_name in df.columns
+    }
+    compact_dtypes_by_col = {
+        col_name: compact_dtype
+        for col_name, compact_dtype in compact_dtypes_by_col.items()
+        if df[col_name].dtype != compact_dtype
+    }
+    if compact_dtypes_by_col:
+        df = df.astype(compact_dtypes_by_col)
+    memory_after = df.memory_usage(deep=True).sum()
+    print(
+        f"compact dtypes: {memory_before} -> {memory_after} bytes,"
+        f" saved {memory_before - memory_after} bytes"
+    )
+    return df
+
+
 # BUG: Cannot validate engine custom type, thus workaround by
 # checking inside Class https://github.com/PrefectHQ/prefect/issues/5663
 @flow(task_runner=SequentialTaskRunner())
@@ -85,27 +516,113 @@ def query_database_to_TimeSeries(
     timestamp_index_name="timestamp",
     timeout=120,
     is_stock: bool = False,  # is it a stock?
+    fetch_size: Optional[int] = None,  # None reads everything at once
+    use_copy: bool = False,  # COPY TO STDOUT; Postgres only
+    read_workers: int = 4,  # concurrent queries if query is a list of partitions
+    query_cache=None,  # QueryResultCache
+    compact: bool = False,  # float32 values & categorical keys, see compact_dtypes
+    validation_mode: str = "pandera",  # see customdatastructures.VALIDATION_MODES
 ):
 
+    cached_df = None
+    # a compact read is cached under another key than the float64 result
+    cache_query = query
+    if compact:
+        cache_query = (
+            [*query, "-- compact"]
+            if isinstance(query, list)
+            else f"{query}\n-- compact"
+        )
+    if query_cache is not None:
+        cached_df = query_cache.get(sql_alchemy_engine, cache_query)
+
     # get Prefect Future
-    database_query = query_database(sql_alchemy_engine=sql_alchemy_engine, query=query)
+    if cached_df is not None:
+        database_query = cached_df
+    elif isinstance(query, list):
+        if use_copy or fetch_size is not None:
+            raise ValueError(
+                "use_copy & fetch_size read a single query; partitions are read"
+                " with read_sql, on read_workers connections"
+            )
+        database_query = query_database_partitions(
+            sql_alchemy_engine=sql_alchemy_engine,
+            queries=query,
+            max_workers=read_workers,
+        )
+    elif use_copy:
+        if sql_alchemy_engine.dialect.name != "postgresql":
+            raise ValueError("use_copy needs a Postgres/Timescale database")
+        database_query = copy_query_database(
+            sql_alchemy_engine=sql_alchemy_engine,
+            query=query,
+            timestamp_col_name=timestamp_index_name,
+            compact_numeric_col_name=numeric_col_name if compact else None,
+        )
+    elif fetch_size is None:
+        database_query = query_database(
+            sql_alchemy_engine=sql_alchemy_engine, query=query
+        )
+    else:
+        database_query = stream_query_database(
+            sql_alchemy_engine=sql_alchemy_engine,
+            query=query,
+            fetch_size=fetch_size,
+            timestamp_col_name=timestamp_index_name,
+            compact_numeric_col_name=numeric_col_name if compact else None,
+        )
 
     # calculate result
 
     prefect_result_df = database_query
 
+    if query_cache is not None and cached_df is None:
+        query_cache.put(sql_alchemy_engine, cache_query, prefect_result_df)
+
     # normalize date
     df = normalize_timestamp(df=prefect_result_df)
 
+    if compact:
+        df = compact_dtypes(df=df, numeric_col_name=numeric_col_name)
+
     if is_stock:
         return StockTimeSeries(
             timestamp_index_name=timestamp_index_name,
             numeric_col_name=numeric_col_name,
             time_series_df=df,
+            validation_mode=validation_mode,
         )
     else:
         return TimeSeries(
             timestamp_index_name=timestamp_index_name,
             numeric_col_name=numeric_col_name,
             time_series_df=df,
+            validation_mode=validation_mode,
+        )
+
+
+CLI_USAGE = """usage, to build once:
+python ingress.py cube cube_folder begin_date end_date
+python ingress.py calendar calendar_folder"""
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["calendar"] and len(sys.argv) == 3:
+        build_trading_calendar(
+            sql_alchemy_engine=create_engine(
+                os.environ["NOISYSTOCKS_STOCKS_DB_CONNECTION_URL"]
+            ),
+            calendar_folder=Path(sys.argv[2]),
         )
+    elif sys.argv[1:2] == ["cube"] and len(sys.argv) == 5:
+        cube_folder, begin_date, end_date = sys.argv[2:5]
+        build_precipitation_cube(
+            sql_alchemy_engine=create_engine(
+                os.environ["NOISYSTOCKS_DATASETS_DB_CONNECTION_URL"]
+            ),
+            cube_folder=Path(cube_folder),
+            begin_date=datetime.strptime(begin_date, "%Y-%m-%d"),
+            end_date=datetime.strptime(end_date, "%Y-%m-%d"),
+        )
+    else:
+        print(CLI_USAGE)
+        sys.exit(2)
@@ -1,8 +1,9 @@
 from datetime import datetime, timedelta
 from os import environ
 from pathlib import Path
+from time import perf_counter
+from typing import Optional
 
-import numpy as np
 import sqlalchemy as db
 from pandas import Series
 from prefect.flows import flow
@@ -11,10 +12,21 @@ from pydantic import PositiveInt
 from pytest import approx
 from sqlalchemy import create_engine
 
-from analysis import correlate_datasets, np_stdev_per_row
-from customdatastructures import CorrDatabaseQuery
+from analysis import (
+    PRECISIONS,
+    RollingCorrelation,
+    find_highest_correlations,
+    top_correlation_significance,
+    warm_up_kernels,
+)
+from customdatastructures import CorrDatabaseQuery, TradingCalendar
 from egress import corr_to_db_content, pickle_object_to_path, publish
-from ingress import fetch_stocks_to_TimeSeries, fetch_weather_to_TimeSeries
+from ingress import (
+    QueryResultCache,
+    fetch_stocks_to_TimeSeries,
+    fetch_weather_to_TimeSeries,
+    query_database,
+)
 
 # TODO: Use Prefect 2.0 blocks
 
@@ -40,6 +52,27 @@ def stock_correlation_flow(
     datasets_db_conn_string=environ["NOISYSTOCKS_DATASETS_DB_CONNECTION_URL"],
     days_ago=None,
     target_date=None,
+    correlation_backend: str = "matrix",  # recommended, see correlate_datasets
+    correlation_search: str = "exhaustive",  # see analysis.CORRELATION_SEARCHES
+    corr_block_size: Optional[PositiveInt] = None,  # dataset cols per block
+    workers: Optional[PositiveInt] = None,  # processes, for backend "process"
+    precision: str = "float64",  # "float32" halves memory, see analysis.PRECISIONS
+    corr_method: str = "pearson",  # see analysis.CORRELATION_METHODS
+    recall_target: float = 0.95,  # for the approximate sketch search
+    search_options: Optional[dict] = None,  # eg. {"scheduler_address": "tcp://..."}
+    datasets_fetch_size: Optional[PositiveInt] = None,  # rows per round trip
+    datasets_use_copy: bool = False,  # bulk read with COPY TO STDOUT
+    # datasets_fetch_size & datasets_use_copy read one query, not with read_workers
+    datasets_read_workers: Optional[PositiveInt] = None,  # concurrent day queries
+    query_cache_folder: Optional[Path] = None,  # None disables the query cache
+    query_cache_data_version: str = "",  # change after re-ingesting data
+    datasets_cube_folder: Optional[Path] = None,  # see build_precipitation_cube
+    datasets_sql_pushdown: bool = False,  # filter 0, NULL & incomplete points in sql
+    compact_ingest: bool = False,  # float32 values & categorical keys while long
+    validation_mode: str = "pandera",  # "numpy" or "sampled" validate faster
+    stocks_calendar_folder: Optional[Path] = None,  # see build_trading_calendar
+    movers_before_pivot: bool = False,  # only pivot the selected stocks
+    rolling_correlation=None,  # RollingCorrelation, for backend "rolling"
 ):
 
     # preferences
@@ -54,6 +87,12 @@ def stock_correlation_flow(
     dataset_database_name = "weather"
     dataset_numeric_col_name = "precipitation"
 
+    query_cache = None
+    if query_cache_folder is not None:
+        query_cache = QueryResultCache(
+            cache_folder=query_cache_folder, data_version=query_cache_data_version
+        )
+
     # SQLAlchemy will not turn itself into a pickle from another process. DO NOT PICKLE!
     # TODO: Refactor to db.create_engine
     sql_alchemy_stock_engine = create_engine(stocks_db_conn_string)
@@ -66,16 +105,42 @@ def stock_correlation_flow(
         target_date=target_date,
     )
 
+    longest_consecutive_days_sequence = None
+    if stocks_calendar_folder is not None:
+        # a lookup in the precomputed calendar; then only query the sequence days
+        longest_consecutive_days_sequence = TradingCalendar(
+            calendar_folder=stocks_calendar_folder
+        ).longest_sequence(
+            begin_timestamp=stocks_db_query_object.output_begin_timestamp(
+                as_string=False
+            ),
+            end_timestamp=stocks_db_query_object.output_end_timestamp(as_string=False),
+        )
+        if not longest_consecutive_days_sequence:
+            raise ValueError("Expected a trading day within the stocks interval")
+        stocks_db_query_object = CorrDatabaseQuery(
+            select_fields=stock_select_fields,
+            from_database=stock_database_name,
+            process_begin_and_end_timestamp=(
+                longest_consecutive_days_sequence[0],
+                longest_consecutive_days_sequence[-1],
+            ),
+        )
+
     # get TimeSeries
     stocks_time_series = fetch_stocks_to_TimeSeries(
         sql_alchemy_engine=sql_alchemy_stock_engine,
         query=stocks_db_query_object.to_sql(),
         numeric_col_name=stocks_numeric_col_name,
+        query_cache=query_cache,
+        compact=compact_ingest,
+        validation_mode=validation_mode,
     )
 
-    longest_consecutive_days_sequence = (
-        stocks_time_series.calc_longest_consecutive_days_sequence()
-    )
+    if longest_consecutive_days_sequence is None:
+        longest_consecutive_days_sequence = (
+            stocks_time_series.calc_longest_consecutive_days_sequence()
+        )
 
     stocks_time_series.drop_row_except(longest_consecutive_days_sequence)
 
@@ -83,20 +148,33 @@ def stock_correlation_flow(
     # if df.empty: Raise ValueError
     # #really it's just df.empty #very nice!
 
-    stocks_time_series.pivot_rows_to_cols(
-        index="timestamp", columns="stock_symbol", values="price_close"
-    )
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision should be one of {PRECISIONS}")
 
-    # SPEED, minor: change order of find_movers_and_shakers and pivot_rows_to_col
-    # (requires refactor)
+    if movers_before_pivot:
+        # rank on the long df, then only pivot the selected stocks
+        largest_stocks = stocks_time_series.find_movers_and_shakers_long(
+            start_date=longest_consecutive_days_sequence[0],
+            end_date=longest_consecutive_days_sequence[-1],
+            min_stocks_output=min_stocks_output,
+            max_stocks_output=min_stocks_output,
+        )
+        stocks_time_series.drop_symbol_rows_except(
+            [stock[0] for stock in largest_stocks]
+        )
 
-    largest_stocks = stocks_time_series.find_movers_and_shakers(  # type: ignore
-        start_date=longest_consecutive_days_sequence[0],
-        end_date=longest_consecutive_days_sequence[-1],
-        min_stocks_output=min_stocks_output,
-        max_stocks_output=min_stocks_output,
+    stocks_time_series.pivot_rows_to_cols(
+        index="timestamp", columns="stock_symbol", values="price_close", dtype=precision
     )
 
+    if not movers_before_pivot:
+        largest_stocks = stocks_time_series.find_movers_and_shakers(  # type: ignore
+            start_date=longest_consecutive_days_sequence[0],
+            end_date=longest_consecutive_days_sequence[-1],
+            min_stocks_output=min_stocks_output,
+            max_stocks_output=min_stocks_output,
+        )
+
     stocks_time_series.drop_col_except([stock[0] for stock in largest_stocks])
 
     dataset_db_query_object = CorrDatabaseQuery(
@@ -107,56 +185,125 @@ def stock_correlation_flow(
             longest_consecutive_days_sequence[-1],  # last el
         ),
     )
-
-    sql_alchemy_datasets_engine = create_engine(datasets_db_conn_string)
-
-    dataset_time_series = fetch_weather_to_TimeSeries(
-        sql_alchemy_engine=sql_alchemy_datasets_engine,
-        query=dataset_db_query_object.to_sql(),
-        numeric_col_name=dataset_numeric_col_name,
-        timeout=120,
-    )
-
-    # should be seperate function; works too
-    dataset_time_series.pivot_rows_to_cols(
-        index="timestamp", columns=dataset_uid_col_name_list, values="precipitation"
-    )
+    if datasets_sql_pushdown:
+        dataset_db_query_object.filter_numeric_col_name = dataset_numeric_col_name
+        dataset_db_query_object.complete_uid_col_names = dataset_uid_col_name_list
+        dataset_db_query_object.sql_dialect = db.engine.make_url(
+            datasets_db_conn_string
+        ).get_backend_name()
+
+    if datasets_cube_folder is not None:
+        # already wide; a view on the memory mapped cube, no sql & no pivot
+        dataset_time_series = fetch_weather_to_TimeSeries(
+            cube_folder=datasets_cube_folder,
+            begin_timestamp=longest_consecutive_days_sequence[0],
+            end_timestamp=longest_consecutive_days_sequence[-1],
+            numeric_col_name=dataset_numeric_col_name,
+        )
+        dataset_time_series.time_series_df = dataset_time_series.time_series_df.astype(
+            precision, copy=False
+        )
+    else:
+        if datasets_read_workers is None:
+            sql_alchemy_datasets_engine = create_engine(datasets_db_conn_string)
+            dataset_query = dataset_db_query_object.to_sql()
+        else:
+            # one query per day; the pool bounds the concurrent connections
+            sql_alchemy_datasets_engine = create_engine(
+                datasets_db_conn_string,
+                poolclass=db.pool.QueuePool,  # also for dialects defaulting to none
+                pool_size=datasets_read_workers,
+                max_overflow=0,
+            )
+            complete_uids = None
+            if datasets_sql_pushdown:
+                # aggregate the completeness once, not again in every partition
+                complete_uids = list(
+                    query_database(
+                        sql_alchemy_engine=sql_alchemy_datasets_engine,
+                        query=dataset_db_query_object.to_complete_uids_sql(),
+                    ).itertuples(index=False, name=None)
+                )
+            dataset_query = dataset_db_query_object.to_sql_partitions(
+                complete_uids=complete_uids
+            )
+
+        dataset_time_series = fetch_weather_to_TimeSeries(
+            sql_alchemy_engine=sql_alchemy_datasets_engine,
+            query=dataset_query,
+            numeric_col_name=dataset_numeric_col_name,
+            timeout=120,
+            fetch_size=datasets_fetch_size,
+            use_copy=datasets_use_copy,
+            read_workers=datasets_read_workers or 1,
+            query_cache=query_cache,
+            compact=compact_ingest,
+            validation_mode=validation_mode,
+        )
+        if query_cache is not None:
+            print(f"query cache hits: {query_cache.hits}, misses: {query_cache.misses}")
+
+        # should be seperate function; works too
+        dataset_time_series.pivot_rows_to_cols(
+            index="timestamp",
+            columns=dataset_uid_col_name_list,
+            values="precipitation",
+            dtype=precision,
+        )
     #   print(stocks_time_series.time_series_df)
 
     stock_col_list = list(stocks_time_series.time_series_df.columns)
     dataset_col_list = list(dataset_time_series.time_series_df.columns)
 
-    # get stock correlations; list containing numpy arrays per stock, one numpy array
+    if correlation_backend == "numba":
+        # compile (or load from the on disk cache) first, so compute time is clean
+        compile_seconds = warm_up_kernels(backend=correlation_backend)
+        print(f"numba kernel compiled or loaded in seconds: {compile_seconds}")
 
-    correlations = correlate_datasets(
+    # get highest correlations; per stock the dataset col index & its correlation
+    # stocks x top_k arrays, top_k is 1
+
+    compute_start_time = perf_counter()
+    max_corr_indexes, highest_corrs = find_highest_correlations(
+        search=correlation_search,
+        backend=correlation_backend,
+        block_size=corr_block_size,
+        workers=workers,
         stocks_np_array=stocks_time_series.time_series_df.to_numpy(),
-        stocks_stdevs=np_stdev_per_row(stocks_time_series.time_series_df.to_numpy()),
-        dataset_stdevs=np_stdev_per_row(dataset_time_series.time_series_df.to_numpy()),
         dataset_np_array=dataset_time_series.time_series_df.to_numpy(),
+        row_labels=stocks_time_series.time_series_df.index,
+        stock_labels=stocks_time_series.time_series_df.columns,
+        dataset_labels=dataset_time_series.time_series_df.columns,
+        method=corr_method,
+        recall_target=recall_target,
+        rolling_correlation=rolling_correlation,
+        **(search_options or {}),
     )
+    print(f"correlations computed in seconds: {perf_counter() - compute_start_time}")
 
-    # print(correlations)
+    significance = top_correlation_significance(
+        stocks_np_array=stocks_time_series.time_series_df.to_numpy(),
+        dataset_np_array=dataset_time_series.time_series_df.to_numpy(),
+        top_indexes=max_corr_indexes[:, 0],
+        top_correlations=highest_corrs[:, 0],
+    )
 
     # sanity check
-    assert len(correlations) == len(stock_col_list)
+    assert len(max_corr_indexes) == len(stock_col_list)
 
     stock_index = 0
     corr_dict = {}
-    # get highest correlations
-    # TODO: refactor into own function
+    max_float64_deviation = 0.0
     # TODO: limit posts per day. Might be a thorny problem because longest_consecutive_days_sequence will cause overlapping periods
     # BUG: Ingesting new stocks to the stock database might publish more posts than requested; the upsert of export assumes the exact same stocks will be upserted each time
     # WORKAROUND: if the stock dataset ever changes, wait until all remaining posts are published.
     # deleting those posts is not a workaround because you woulnd't be able to determinstically build up the same database from the existing pickles
 
-    for stock_corr in correlations:
-        # sanity check
-        assert len(stock_corr) == len(dataset_col_list)
-        # grab index of highest abs correlation
-        max_corr_index = np.argmax(np.abs(stock_corr))
-        highest_corr = stock_corr[max_corr_index]
+    for stock in stock_col_list:
+        # index of highest abs correlation
+        max_corr_index = max_corr_indexes[stock_index][0]
+        highest_corr = highest_corrs[stock_index][0]
         dataset_uid = dataset_col_list[max_corr_index]
-        stock = stock_col_list[stock_index]
         corr_dict[stock] = {
             "begin_date": longest_consecutive_days_sequence[0],
             "end_date": longest_consecutive_days_sequence[-1],
@@ -169,14 +316,26 @@ def stock_correlation_flow(
             "dataset_uid_col_name_list": dataset_uid_col_name_list,  # eg. (lat,lon)
             "dataset_pd_series": dataset_time_series.time_series_df[dataset_uid],
             "dataset_num_col": dataset_time_series.numeric_col_name,  # contains timestamps + values
+            "p_value": significance["p_values"][stock_index],
+            # p-value of the best out of every dataset col, see analysis.py
+            "family_p_value": significance["family_p_values"][stock_index],
+            "corr_method": corr_method,  # eg. pearson
         }
         assert isinstance(corr_dict[stock]["stock_pd_series"], Series)
         assert isinstance(corr_dict[stock]["dataset_pd_series"], Series)
 
         corr_pd = corr_dict[stock]["stock_pd_series"].corr(
-            corr_dict[stock]["dataset_pd_series"]
-        )
-        assert corr_pd == approx(corr_dict[stock]["highest_corr"])
+            corr_dict[stock]["dataset_pd_series"], method=corr_method
+        )  # pandas correlates in float64, regardless of precision
+        if precision == "float64":
+            assert corr_pd == approx(corr_dict[stock]["highest_corr"])
+        else:
+            max_float64_deviation = max(
+                max_float64_deviation, abs(corr_pd - highest_corr)
+            )
+            assert corr_pd == approx(highest_corr, abs=1e-4)
+            # publish the float64 value; egress checks it against pandas again
+            corr_dict[stock]["highest_corr"] = corr_pd
 
         # corr_dict fields:
         # dict of dicts,
@@ -185,6 +344,8 @@ def stock_correlation_flow(
         stock_index += 1
 
     print(corr_dict)
+    if precision != "float64":
+        print(f"{precision} max deviation from float64: {max_float64_deviation}")
     pickle_object_to_path(corr_dict, folder_path=Path(corr_dict_pickle_storage_path))
     # print(corr_dict)
 
@@ -243,6 +404,26 @@ def correlate_and_publish(
     post_schedule_start_date=datetime.today(),  # date to publish posts
     days_ago=None,
     target_date=None,  # date to analyze correlations
+    correlation_backend: str = "matrix",
+    correlation_search: str = "exhaustive",
+    corr_block_size: Optional[PositiveInt] = None,
+    workers: Optional[PositiveInt] = None,
+    precision: str = "float64",
+    corr_method: str = "pearson",
+    recall_target: float = 0.95,
+    search_options: Optional[dict] = None,
+    datasets_fetch_size: Optional[PositiveInt] = None,
+    datasets_use_copy: bool = False,
+    datasets_read_workers: Optional[PositiveInt] = None,
+    query_cache_folder: Optional[Path] = None,
+    query_cache_data_version: str = "",
+    datasets_cube_folder: Optional[Path] = None,
+    datasets_sql_pushdown: bool = False,
+    compact_ingest: bool = False,
+    validation_mode: str = "pandera",
+    stocks_calendar_folder: Optional[Path] = None,
+    movers_before_pivot: bool = False,
+    rolling_correlation=None,  # RollingCorrelation
 ):
 
     published_posts_count = count_published_posts(
@@ -266,6 +447,26 @@ def correlate_and_publish(
         datasets_db_conn_string=datasets_db_conn_string,
         days_ago=days_ago,
         target_date=target_date,
+        correlation_backend=correlation_backend,
+        correlation_search=correlation_search,
+        corr_block_size=corr_block_size,
+        workers=workers,
+        precision=precision,
+        corr_method=corr_method,
+        recall_target=recall_target,
+        search_options=search_options,
+        datasets_fetch_size=datasets_fetch_size,
+        datasets_use_copy=datasets_use_copy,
+        datasets_read_workers=datasets_read_workers,
+        query_cache_folder=query_cache_folder,
+        query_cache_data_version=query_cache_data_version,
+        datasets_cube_folder=datasets_cube_folder,
+        datasets_sql_pushdown=datasets_sql_pushdown,
+        compact_ingest=compact_ingest,
+        validation_mode=validation_mode,
+        stocks_calendar_folder=stocks_calendar_folder,
+        movers_before_pivot=movers_before_pivot,
+        rolling_correlation=rolling_correlation,
     )
 
     corr_to_db_content(content_db_conn_string=content_db_conn_string)
@@ -281,8 +482,18 @@ def correlate_and_publish(
 
 
 # BUG: If this is a Prefect flow, it times out after running ~10 minutes.
-def precompute_content(start_date: datetime, calc_next_days):
-    """calculate content as if run on start_date"""
+def precompute_content(
+    start_date: datetime, calc_next_days, correlation_backend: str = "matrix"
+):
+    """calculate content as if run on start_date
+
+    Opt-in: the rolling backend reuses the sums of the previous target date when
+    the windows overlap. The windows are a single Mon-Fri run, so consecutive
+    target dates mostly give identical or disjoint windows; it rarely pays off.
+    The engine lives only for this backfill."""
+    rolling_correlation = None
+    if correlation_backend == "rolling":
+        rolling_correlation = RollingCorrelation()
     future_date = start_date  # start future date at today
     target_days_ago = (20 * 365) + 5  # roughly 20 years ago
     target_date = future_date - timedelta(days=target_days_ago)
@@ -295,7 +506,10 @@ def precompute_content(start_date: datetime, calc_next_days):
         print(f"\n target date {target_date} \n ")
         print(f"\n calculating correlation & publishing on: {future_date} \n")
         correlate_and_publish(
-            post_schedule_start_date=future_date, target_date=target_date
+            post_schedule_start_date=future_date,
+            target_date=target_date,
+            correlation_backend=correlation_backend,
+            rolling_correlation=rolling_correlation,
         )
         print(f"\n calculated correlation & publishing on: {future_date} \n")
         print(
@@ -1,10 +1,14 @@
-from datetime import datetime
+import sqlite3
+from datetime import datetime, timezone
+from decimal import Decimal
 from os import mkdir
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import pytest
 from freezegun import freeze_time
+from sqlalchemy import create_engine
 from noisy_stocks_data_orchestrator.customdatastructures import (
     CorrDatabaseQuery,
     StockTimeSeries,
@@ -475,3 +479,113 @@ def fixt_dataframe_date_missing_filtered_and_pivoted():
     # clarification: a pivot table includes the original name of the col
 
     return df
+
+
+@pytest.fixture
+def fixt_corr_dataframes():
+    """wide stock & dataset frames as produced by pivot_rows_to_cols
+
+    returns (stocks_df, dataset_df) sharing the same 11 day index"""
+    rng = np.random.default_rng(seed=42)
+    index = pd.date_range(start="2002-07-01", periods=11, freq="D", name="timestamp")
+    stocks_df = pd.DataFrame(
+        rng.uniform(low=5, high=50, size=(11, 4)),
+        index=index,
+        columns=["A", "B", "C", "D"],
+    )
+    dataset_df = pd.DataFrame(
+        rng.gamma(shape=0.8, scale=4, size=(11, 37)),
+        index=index,
+    )
+    # plant a perfect (negative) correlation to find back
+    dataset_df[5] = stocks_df["C"] * -2 + 120
+    return stocks_df, dataset_df
+
+
+@pytest.fixture
+def fixt_weather_sqlite_engine(tmp_path):
+    """local stand-in for the weather database; sqlite file with a weather table
+
+    5 days x 6 grid points, one precipitation value is NULL"""
+    rng = np.random.default_rng(seed=1)
+    weather_df = pd.DataFrame(
+        [
+            {
+                "timestamp": f"2002-07-0{day}T00:00:00+00:00",
+                "longitude": longitude,
+                "latitude": latitude,
+                "precipitation": rng.gamma(shape=0.8, scale=4),
+            }
+            for day in range(1, 6)
+            for longitude in (4.0, 4.5, 5.0)
+            for latitude in (50.0, 50.5)
+        ]
+    )
+    weather_df.loc[7, "precipitation"] = None
+    sql_alchemy_engine = create_engine(f"sqlite:///{tmp_path / 'weather.db'}")
+    weather_df.to_sql("weather", sql_alchemy_engine, index=False)
+    return sql_alchemy_engine
+
+
+# sqlite reads a TIMESTAMPTZ col (with detect_types=1) as UTC, as Postgres does;
+# check_same_thread=false lets the read_workers threads share the pool
+# like a Postgres NUMERIC col, which psycopg2 returns as Decimal
+sqlite3.register_converter("DECIMAL", lambda number: Decimal(number.decode()))
+sqlite3.register_converter(
+    "TIMESTAMPTZ",
+    lambda timestamp: datetime.fromisoformat(timestamp.decode()).replace(
+        tzinfo=timezone.utc
+    ),
+)
+
+
+@pytest.fixture
+def fixt_flow_sqlite_conn_strings(tmp_path):
+    """local stand-ins for the stock & weather databases of stock_correlation_flow
+
+    stock_timedata: 20 stocks (the flow's default treshold) x 5 days (Mon
+    2002-07-01 until Fri)
+    weather: the same 5 days x 6 grid points; one 0 & one NULL value, so 2 grid
+    points are incomplete"""
+    rng = np.random.default_rng(seed=3)
+    days = [f"2002-07-0{day}" for day in range(1, 6)]
+    stock_df = pd.DataFrame(
+        [
+            {
+                "timestamp": day,
+                "stock_symbol": stock_symbol,
+                "price_close": rng.gamma(shape=2, scale=20),
+            }
+            for day in days
+            for stock_symbol in (f"S{symbol:02}" for symbol in range(20))
+        ]
+    )
+    weather_df = pd.DataFrame(
+        [
+            {
+                "timestamp": day,
+                "longitude": longitude,
+                "latitude": latitude,
+                "precipitation": rng.gamma(shape=0.8, scale=4),
+            }
+            for day in days
+            for longitude in (4.0, 4.5, 5.0)
+            for latitude in (50.0, 50.5)
+        ]
+    )
+    weather_df.loc[7, "precipitation"] = None
+    weather_df.loc[20, "precipitation"] = 0
+    conn_strings = []
+    for table_name, df, col_types in (
+        ("stock_timedata", stock_df, "stock_symbol TEXT, price_close REAL"),
+        ("weather", weather_df, "longitude REAL, latitude REAL, precipitation REAL"),
+    ):
+        conn_string = f"sqlite:///{tmp_path / table_name}.db?detect_types=1&check_same_thread=false"
+        sql_alchemy_engine = create_engine(conn_string)
+        with sql_alchemy_engine.begin() as connection:
+            connection.exec_driver_sql(
+                f"CREATE TABLE {table_name} (timestamp TIMESTAMPTZ, {col_types})"
+            )
+        df.to_sql(table_name, sql_alchemy_engine, index=False, if_exists="append")
+        conn_strings.append(conn_string)
+    return tuple(conn_strings)
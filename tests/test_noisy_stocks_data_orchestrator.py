@@ -1,20 +1,64 @@
+import os
 from datetime import datetime
+from io import BytesIO
 from itertools import combinations
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import pandas.testing
 import pytest
+from dask.distributed import LocalCluster
 from egress import create_folder
 from freezegun import freeze_time
+from ingress import (
+    QueryResultCache,
+    build_precipitation_cube,
+    build_trading_calendar,
+    compact_dtypes,
+    fetch_weather_to_TimeSeries,
+    parse_copy_csv,
+    query_database,
+    query_database_partitions,
+    query_database_to_TimeSeries,
+    stream_query_database,
+)
 from noisy_stocks_data_orchestrator import __version__, main_flow
+from noisy_stocks_data_orchestrator.analysis import (
+    RollingCorrelation,
+    benjamini_hochberg,
+    calibrate_sketch_top_corr,
+    coarse_to_fine_top_corr,
+    correlate_datasets,
+    correlation_significance,
+    dask_top_corr,
+    float64_max_deviation,
+    grid_cell_codes,
+    max_statistic_p_values,
+    measure_recall,
+    np_stdev_per_row,
+    pearson_corr,
+    pearson_corr_matrix,
+    process_pool_top_corr,
+    rank_cols,
+    streaming_top_corr,
+    top_abs_corr,
+    warm_up_kernels,
+)
 from noisy_stocks_data_orchestrator.customdatastructures import (
+    CorrDatabaseQuery,
+    PrecipitationCube,
     StockTimeSeries,
+    TradingCalendar,
     folder_exists,
+    longest_run,
+    pivot_without_aggregation,
 )
 from pandera.errors import SchemaError
 from prefect.flows import flow
 from pytest import approx
+from scipy.stats import pearsonr
+from sqlalchemy import create_engine, text
 
 from tests.conftest import stock_with_negative_closing_price, stock_with_unequal_rows
 
@@ -318,6 +362,32 @@ def test_longest_consecutive_days_sequence_missing(fixt_time_series_date_missing
     assert time_series == tuple(dates)
 
 
+def test_longest_run_takes_the_last_of_equally_long_runs():
+    assert longest_run(np.array([1, 1, 0, 1, 0, 1, 1], dtype=bool)) == (5, 2)
+    assert longest_run(np.array([0, 1, 1, 1, 0, 1], dtype=bool)) == (1, 3)
+    assert longest_run(np.zeros(3, dtype=bool)) == (0, 0)
+
+
+def test_longest_consecutive_days_sequences_per_window(fixt_time_series_date_missing):
+    dates = fixt_time_series_date_missing.calc_longest_consecutive_days_sequences(
+        windows=[
+            (pd.Timestamp("2002-07-01"), pd.Timestamp("2002-07-31")),
+            (pd.Timestamp("2002-07-05"), pd.Timestamp("2002-07-06")),
+            (pd.Timestamp("2002-07-05"), pd.Timestamp("2002-07-08")),
+            (pd.Timestamp("2002-07-01"), pd.Timestamp("2002-07-04")),
+        ],
+        treshold=2,
+    )
+    assert dates == [
+        tuple(pd.date_range("2002-07-07", "2002-07-09", freq="D")),
+        (pd.Timestamp("2002-07-05"),),
+        tuple(pd.date_range("2002-07-07", "2002-07-08", freq="D")),
+        tuple(),
+    ]
+    with pytest.raises(ValueError):
+        fixt_time_series_date_missing.calc_longest_consecutive_days_sequence(treshold=3)
+
+
 def test_drop_except(
     fixt_time_series_date_missing, fixt_time_series_date_missing_filtered
 ):
@@ -418,3 +488,1272 @@ def test_find_movers_and_shakers_max_cutoff(fixt_time_series_date_missing_filter
         ("B", approx(0.45269207087637686)),
         ("A", approx(0.12106212702965258)),
     )
+
+
+def test_pearson_corr_matrix_matches_series_corr(fixt_corr_dataframes):
+    stocks_df, dataset_df = fixt_corr_dataframes
+    correlations = pearson_corr_matrix(
+        stocks_np_array=stocks_df.to_numpy(), dataset_np_array=dataset_df.to_numpy()
+    )
+    assert correlations.shape == (stocks_df.shape[1], dataset_df.shape[1])
+    for stock_index, stock in enumerate(stocks_df.columns):
+        for dataset_index, dataset_col in enumerate(dataset_df.columns):
+            assert correlations[stock_index, dataset_index] == approx(
+                stocks_df[stock].corr(dataset_df[dataset_col])
+            )
+    assert correlations[2, 5] == approx(-1)
+
+
+def test_pearson_corr_matrix_blocked_matches_numba_kernel(fixt_corr_dataframes):
+    stocks_np_array, dataset_np_array = (df.to_numpy() for df in fixt_corr_dataframes)
+    numba_correlations = pearson_corr(
+        stocks_np_array=stocks_np_array,
+        dataset_np_array=dataset_np_array,
+        stocks_stdevs=np_stdev_per_row(stocks_np_array),
+        dataset_stdevs=np_stdev_per_row(dataset_np_array),
+    )
+    blocked_correlations = pearson_corr_matrix(
+        stocks_np_array=stocks_np_array,
+        dataset_np_array=dataset_np_array,
+        block_size=5,
+    )
+    np.testing.assert_allclose(np.array(list(numba_correlations)), blocked_correlations)
+
+
+def test_pearson_corr_matrix_constant_col_is_nan():
+    stocks_np_array = np.array([[1.0], [2.0], [3.0]])
+    dataset_np_array = np.array([[2.0, 1.0], [2.0, 4.0], [2.0, 2.0]])
+    correlations = pearson_corr_matrix(
+        stocks_np_array=stocks_np_array, dataset_np_array=dataset_np_array
+    )
+    assert np.isnan(correlations[0, 0])
+    assert np.isnan(pd.Series([1.0, 2.0, 3.0]).corr(pd.Series([2.0, 2.0, 2.0])))
+    assert correlations[0, 1] == approx(
+        pd.Series([1.0, 2.0, 3.0]).corr(pd.Series([1.0, 4.0, 2.0]))
+    )
+
+
+@pytest.mark.parametrize("block_size", [1, 4, 37, 1000])
+def test_streaming_top_corr_matches_full_matrix(fixt_corr_dataframes, block_size):
+    stocks_np_array, dataset_np_array = (df.to_numpy() for df in fixt_corr_dataframes)
+    full_correlations = pearson_corr_matrix(
+        stocks_np_array=stocks_np_array, dataset_np_array=dataset_np_array
+    )
+    expected_indexes, expected_correlations = top_abs_corr(full_correlations, top_k=3)
+
+    indexes, correlations = streaming_top_corr(
+        stocks_np_array=stocks_np_array,
+        dataset_np_array=dataset_np_array,
+        block_size=block_size,
+        top_k=3,
+    )
+    assert indexes.shape == (stocks_np_array.shape[1], 3)
+    np.testing.assert_array_equal(indexes, expected_indexes)
+    np.testing.assert_allclose(correlations, expected_correlations)
+    assert indexes[2][0] == 5  # planted perfect correlation
+    assert correlations[2][0] == approx(-1)
+
+
+def test_top_abs_corr_ignores_nan():
+    correlations = np.array([[np.nan, 0.2, -0.7], [np.nan, np.nan, 0.1]])
+    indexes, top_correlations = top_abs_corr(correlations, top_k=1)
+    np.testing.assert_array_equal(indexes, [[2], [2]])
+    np.testing.assert_allclose(top_correlations, [[-0.7], [0.1]])
+
+
+def test_pivot_rows_to_cols_float32(
+    fixt_time_series_date_missing_filtered,
+    fixt_dataframe_date_missing_filtered_and_pivoted,
+):
+    fixt_time_series_date_missing_filtered.pivot_rows_to_cols(
+        index="timestamp", columns="stock_symbol", values="close_price", dtype="float32"
+    )
+    pandas.testing.assert_frame_equal(
+        left=fixt_time_series_date_missing_filtered.time_series_df,
+        right=fixt_dataframe_date_missing_filtered_and_pivoted.astype("float32"),
+    )
+
+
+@pytest.mark.parametrize("block_size", [None, 7])
+def test_float32_correlations_close_to_float64(fixt_corr_dataframes, block_size):
+    stocks_np_array, dataset_np_array = (
+        df.to_numpy(dtype=np.float32) for df in fixt_corr_dataframes
+    )
+    # large offset; naive sum of squares would lose every digit in float32
+    dataset_np_array += np.float32(10000)
+    correlations = pearson_corr_matrix(
+        stocks_np_array=stocks_np_array,
+        dataset_np_array=dataset_np_array,
+        block_size=block_size,
+    )
+    assert correlations.dtype == np.float32
+    assert (
+        float64_max_deviation(
+            stocks_np_array=stocks_np_array,
+            dataset_np_array=dataset_np_array,
+            correlations=correlations,
+        )
+        < 1e-4
+    )
+
+
+def test_rolling_correlation_matches_full_recalculation(fixt_corr_dataframes):
+    stocks_df, dataset_df = fixt_corr_dataframes
+    rolling_correlation = RollingCorrelation()
+
+    # slide a 7 day window over the 11 days, with changing cols along the way
+    windows = [
+        (slice(0, 7), ["A", "B", "C", "D"], list(range(37))),
+        (slice(1, 8), ["A", "B", "C", "D"], list(range(37))),
+        (slice(2, 9), ["D", "B", "C"], list(range(3, 30))),
+        (slice(4, 11), ["A", "C", "E"], list(range(0, 37, 2))),
+        (slice(0, 4), ["A", "B"], list(range(37))),  # no overlap
+    ]
+    stocks_df = stocks_df.assign(E=stocks_df["A"] * 3 + 1000)
+    for rows, stock_cols, dataset_cols in windows:
+        stocks_window = stocks_df.iloc[rows][stock_cols]
+        dataset_window = dataset_df.iloc[rows][dataset_cols]
+        correlations = rolling_correlation.update(
+            row_labels=stocks_window.index,
+            stocks_np_array=stocks_window.to_numpy(),
+            dataset_np_array=dataset_window.to_numpy(),
+            stock_labels=stocks_window.columns,
+            dataset_labels=dataset_window.columns,
+        )
+        np.testing.assert_allclose(
+            correlations,
+            pearson_corr_matrix(
+                stocks_np_array=stocks_window.to_numpy(),
+                dataset_np_array=dataset_window.to_numpy(),
+            ),
+        )
+    assert rolling_correlation.full_calculation_count == 2  # first & last window
+    assert rolling_correlation.incremental_update_count == 3
+
+
+def test_warm_up_kernels_covers_calls(fixt_corr_dataframes):
+    compile_seconds = warm_up_kernels()
+    assert set(compile_seconds) == {"pearson_corr"}
+    signature_count = len(pearson_corr.signatures)
+
+    # pivoted frames hand over C or Fortran ordered arrays; no extra compilation
+    for dtype in (np.float64, np.float32):
+        for stocks_layout, dataset_layout in (
+            (np.ascontiguousarray, np.ascontiguousarray),
+            (np.asfortranarray, np.asfortranarray),
+            (np.ascontiguousarray, np.asfortranarray),
+        ):
+            stocks_np_array, dataset_np_array = (
+                layout(df.to_numpy(dtype=dtype))
+                for layout, df in zip(
+                    (stocks_layout, dataset_layout), fixt_corr_dataframes
+                )
+            )
+            correlate_datasets(
+                backend="numba",
+                stocks_np_array=stocks_np_array,
+                dataset_np_array=dataset_np_array,
+            )
+        # called directly, Fortran ordered input dispatches without a copy
+        pearson_corr(
+            np_stdev_per_row(dataset_np_array),
+            np_stdev_per_row(stocks_np_array),
+            stocks_np_array=np.asfortranarray(stocks_np_array),
+            dataset_np_array=dataset_np_array,
+        )
+    assert len(pearson_corr.signatures) == signature_count
+    assert set(warm_up_kernels(backend="numba")) == {"pearson_corr"}
+    assert warm_up_kernels(backend="matrix") == {}
+
+
+def test_correlation_significance_matches_scipy(fixt_corr_dataframes):
+    stocks_df, dataset_df = fixt_corr_dataframes
+    correlations = pearson_corr_matrix(
+        stocks_np_array=stocks_df.to_numpy(), dataset_np_array=dataset_df.to_numpy()
+    )
+    significance = correlation_significance(
+        correlations,
+        stocks_np_array=stocks_df.to_numpy(),
+        dataset_np_array=dataset_df.to_numpy(),
+        effective_sample_size=False,
+    )
+    for stock_index, stock in enumerate(stocks_df.columns):
+        for dataset_index in (0, 5, 36):
+            _, expected_p_value = pearsonr(
+                stocks_df[stock], dataset_df.iloc[:, dataset_index]
+            )
+            assert significance["p_values"][stock_index, dataset_index] == approx(
+                expected_p_value, abs=1e-12
+            )
+    assert (significance["q_values"] >= significance["p_values"] - 1e-12).all()
+
+    # autocorrelation can only shrink the sample size
+    effective_significance = correlation_significance(
+        correlations,
+        stocks_np_array=stocks_df.to_numpy(),
+        dataset_np_array=dataset_df.to_numpy(),
+    )
+    assert (effective_significance["row_counts"] <= len(stocks_df)).all()
+
+
+def test_benjamini_hochberg():
+    p_values = np.array([[0.01, 0.04, 0.03, 0.005], [0.5, 0.5, 0.5, 0.5]])
+    np.testing.assert_allclose(
+        benjamini_hochberg(p_values),
+        [[0.02, 0.04, 0.04, 0.02], [0.5, 0.5, 0.5, 0.5]],
+    )
+
+
+def test_max_statistic_p_values():
+    with np.errstate(all="raise"):  # p = 1 without a divide warning
+        p_values = max_statistic_p_values(np.array([0.0, 0.01, 1.0]), test_count=3)
+    np.testing.assert_allclose(p_values, [0.0, 1 - 0.99**3, 1.0])
+
+
+def test_spearman_matches_series_corr(fixt_corr_dataframes):
+    stocks_df, dataset_df = fixt_corr_dataframes
+    # precipitation is skewed & full of ties
+    dataset_df = dataset_df.round(0)
+    stocks_df["D"] = [1.0, 2, 2, 3, 3, 3, 4, 5, 5, 6, 7]
+    correlations = pearson_corr_matrix(
+        stocks_np_array=rank_cols(stocks_df.to_numpy()),
+        dataset_np_array=rank_cols(dataset_df.to_numpy()),
+    )
+    for stock_index, stock in enumerate(stocks_df.columns):
+        for dataset_index, dataset_col in enumerate(dataset_df.columns):
+            assert correlations[stock_index, dataset_index] == approx(
+                stocks_df[stock].corr(dataset_df[dataset_col], method="spearman"),
+                nan_ok=True,
+            )
+
+
+def test_sketch_top_corr_reaches_recall_target():
+    rng = np.random.default_rng(seed=7)
+    stocks_np_array = rng.normal(size=(60, 12))
+    dataset_np_array = rng.gamma(shape=0.8, scale=4, size=(60, 3000))
+    # every stock has one strongly related grid point
+    dataset_np_array[:, 100:112] = stocks_np_array * 2 + rng.normal(size=(60, 12))
+
+    exact_indexes, exact_correlations = streaming_top_corr(
+        stocks_np_array, dataset_np_array
+    )
+    indexes, correlations, recall_report = calibrate_sketch_top_corr(
+        stocks_np_array,
+        dataset_np_array,
+        recall_target=0.9,
+        sketch_size=16,
+        candidate_count=4,
+        block_size=1000,
+    )
+    assert recall_report["recall"] >= 0.9
+    assert measure_recall(indexes, exact_indexes) >= 0.9
+    # verified correlations are exact wherever the best col was found
+    found = indexes[:, 0] == exact_indexes[:, 0]
+    np.testing.assert_allclose(correlations[found], exact_correlations[found])
+
+
+def test_sketch_top_corr_calibrates_once_per_window_shape():
+    rng = np.random.default_rng(seed=7)
+    stocks_np_array = rng.normal(size=(60, 12))
+    dataset_np_array = rng.gamma(shape=0.8, scale=4, size=(60, 3000))
+    calibrations = {}
+    recall_reports = [
+        calibrate_sketch_top_corr(
+            stocks_np_array,
+            dataset_np_array,
+            recall_target=0.9,
+            sketch_size=16,
+            calibrations=calibrations,
+        )[2]
+        for _ in range(2)
+    ]
+    assert len(calibrations) == 1
+    assert recall_reports[0]["recall"] is not None
+    assert recall_reports[1] == {
+        "candidate_count": recall_reports[0]["candidate_count"],
+        "recall": None,
+    }
+
+
+def test_sketch_top_corr_is_exact_without_reduction():
+    rng = np.random.default_rng(seed=7)
+    # one trading week: 5 rows, fewer than the sketch_size
+    stocks_np_array = rng.normal(size=(5, 12))
+    dataset_np_array = rng.gamma(shape=0.8, scale=4, size=(5, 300))
+    calibrations = {}
+    indexes, correlations, recall_report = calibrate_sketch_top_corr(
+        stocks_np_array, dataset_np_array, sketch_size=8, calibrations=calibrations
+    )
+    exact_indexes, exact_correlations = streaming_top_corr(
+        stocks_np_array, dataset_np_array
+    )
+    np.testing.assert_array_equal(indexes, exact_indexes)
+    np.testing.assert_allclose(correlations, exact_correlations)
+    assert recall_report["recall"] == 1.0
+    assert not calibrations
+
+
+def test_grid_cell_codes_pools_neighbouring_points():
+    latitudes = np.array([50.0, 50.0, 50.5, 50.5, 51.0, 51.0])
+    longitudes = np.array([4.0, 4.5, 4.0, 4.5, 4.0, 4.5])
+    cell_codes = grid_cell_codes(latitudes, longitudes, pool_factor=2)
+    assert list(cell_codes) == [0, 0, 0, 0, 1, 1]
+    assert len(set(grid_cell_codes(latitudes, longitudes, pool_factor=1))) == 6
+
+
+def test_coarse_to_fine_top_corr_agrees_with_exhaustive_search():
+    rng = np.random.default_rng(seed=11)
+    grid_latitudes, grid_longitudes = np.meshgrid(
+        np.arange(40) * 0.5, np.arange(40) * 0.5, indexing="ij"
+    )
+    latitudes, longitudes = grid_latitudes.ravel(), grid_longitudes.ravel()
+    # spatially smooth field: weather systems with a random strength per day
+    centres = np.array([[3, 3], [3, 10], [3, 17], [15, 4], [15, 11], [15, 17.5]])
+    strengths = rng.gamma(shape=2, scale=2, size=(60, 6))
+    footprints = np.exp(
+        -(
+            (latitudes[:, np.newaxis] - centres[:, 0]) ** 2
+            + (longitudes[:, np.newaxis] - centres[:, 1]) ** 2
+        )
+        / 4
+    )
+    dataset_np_array = strengths @ footprints.T + rng.normal(scale=0.1, size=(60, 1600))
+    stocks_np_array = strengths + rng.normal(scale=0.5, size=(60, 6))
+
+    exact_indexes, exact_correlations = streaming_top_corr(
+        stocks_np_array, dataset_np_array
+    )
+    indexes, correlations = coarse_to_fine_top_corr(
+        stocks_np_array,
+        dataset_np_array,
+        latitudes,
+        longitudes,
+        pool_factors=(8, 2),
+        refine_count=3,
+    )
+    assert indexes.shape == correlations.shape == (6, 1)
+    # misses land on a neighbouring point that correlates nearly as well
+    np.testing.assert_allclose(
+        np.abs(correlations), np.abs(exact_correlations), atol=0.01
+    )
+    found = indexes[:, 0] == exact_indexes[:, 0]
+    np.testing.assert_allclose(correlations[found], exact_correlations[found])
+
+    # refining every cell is the exhaustive search
+    indexes, correlations = coarse_to_fine_top_corr(
+        stocks_np_array,
+        dataset_np_array,
+        latitudes,
+        longitudes,
+        pool_factors=(8,),
+        refine_count=25,
+        top_k=3,
+    )
+    np.testing.assert_array_equal(
+        indexes, streaming_top_corr(stocks_np_array, dataset_np_array, top_k=3)[0]
+    )
+
+
+@pytest.mark.parametrize("workers,block_size", [(1, None), (2, None), (2, 7)])
+def test_process_pool_top_corr_matches_streaming(workers, block_size):
+    rng = np.random.default_rng(seed=3)
+    stocks_np_array = rng.normal(size=(30, 5))
+    dataset_np_array = rng.gamma(shape=0.8, scale=4, size=(30, 50))
+    dataset_np_array[:, 23] = stocks_np_array[:, 2] * -3
+
+    indexes, correlations = process_pool_top_corr(
+        stocks_np_array,
+        dataset_np_array,
+        workers=workers,
+        block_size=block_size,
+        top_k=2,
+    )
+    exact_indexes, exact_correlations = streaming_top_corr(
+        stocks_np_array, dataset_np_array, top_k=2
+    )
+    np.testing.assert_array_equal(indexes, exact_indexes)
+    np.testing.assert_allclose(correlations, exact_correlations)
+    assert indexes[2, 0] == 23
+
+
+def test_dask_top_corr_on_local_cluster_matches_streaming():
+    rng = np.random.default_rng(seed=5)
+    stocks_np_array = rng.normal(size=(30, 5))
+    dataset_np_array = rng.gamma(shape=0.8, scale=4, size=(30, 70))
+    dataset_np_array[:, 41] = stocks_np_array[:, 4] * 2 + 1
+
+    exact_indexes, exact_correlations = streaming_top_corr(
+        stocks_np_array, dataset_np_array, top_k=2
+    )
+    with LocalCluster(
+        n_workers=2, threads_per_worker=1, dashboard_address=None
+    ) as cluster:
+        indexes, correlations = dask_top_corr(
+            stocks_np_array,
+            dataset_np_array,
+            block_size=9,
+            top_k=2,
+            scheduler_address=cluster.scheduler_address,
+        )
+    np.testing.assert_array_equal(indexes, exact_indexes)
+    np.testing.assert_allclose(correlations, exact_correlations)
+    assert indexes[4, 0] == 41
+
+
+@pytest.mark.parametrize("fetch_size", [1, 4, 1000])
+def test_stream_query_database_matches_read_sql(fixt_weather_sqlite_engine, fetch_size):
+    query = "SELECT timestamp, longitude, latitude, precipitation FROM weather;"
+
+    @flow
+    def query_both():
+        return (
+            query_database(sql_alchemy_engine=fixt_weather_sqlite_engine, query=query),
+            stream_query_database(
+                sql_alchemy_engine=fixt_weather_sqlite_engine,
+                query=query,
+                fetch_size=fetch_size,
+            ),
+        )
+
+    read_sql_df, streamed_df = query_both()
+    assert streamed_df["timestamp"].dt.tz is not None
+    read_sql_df["timestamp"] = pd.to_datetime(read_sql_df["timestamp"], utc=True)
+    pandas.testing.assert_frame_equal(streamed_df, read_sql_df)
+    assert streamed_df["precipitation"].isna().sum() == 1
+
+
+def test_stream_query_database_without_rows(fixt_weather_sqlite_engine):
+    @flow
+    def query_no_rows():
+        return stream_query_database(
+            sql_alchemy_engine=fixt_weather_sqlite_engine,
+            query="SELECT timestamp, precipitation FROM weather WHERE 1 = 0;",
+            fetch_size=4,
+        )
+
+    streamed_df = query_no_rows()
+    assert list(streamed_df.columns) == ["timestamp", "precipitation"]
+    assert streamed_df.empty
+
+
+def test_stream_query_database_coerces_decimal_to_float(tmp_path):
+    sql_alchemy_engine = create_engine(
+        f"sqlite:///{tmp_path / 'stocks.db'}?detect_types=1"
+    )
+    with sql_alchemy_engine.begin() as connection:
+        connection.execute(
+            text("CREATE TABLE stock_timedata (timestamp TEXT, price_close DECIMAL);")
+        )
+        connection.execute(
+            text(
+                "INSERT INTO stock_timedata VALUES ('2002-07-01', NULL),"
+                " ('2002-07-02', '16.25'), ('2002-07-03', '21.5');"
+            )
+        )
+    query = "SELECT timestamp, price_close FROM stock_timedata;"
+
+    @flow
+    def query_both():
+        return (
+            query_database(sql_alchemy_engine=sql_alchemy_engine, query=query),
+            stream_query_database(
+                sql_alchemy_engine=sql_alchemy_engine, query=query, fetch_size=1
+            ),
+        )
+
+    read_sql_df, streamed_df = query_both()
+    assert read_sql_df["price_close"].dtype == np.float64
+    pandas.testing.assert_series_equal(
+        streamed_df["price_close"], read_sql_df["price_close"]
+    )
+
+
+def test_query_database_to_TimeSeries_streams_with_fetch_size(
+    fixt_weather_sqlite_engine,
+):
+    time_series = query_database_to_TimeSeries(
+        sql_alchemy_engine=fixt_weather_sqlite_engine,
+        query="SELECT timestamp, longitude, latitude, precipitation FROM weather;",
+        numeric_col_name="precipitation",
+        fetch_size=4,
+    )
+    # the NULL row is dropped by the TimeSeries cleaning
+    assert len(time_series.time_series_df) == 29
+    assert time_series.time_series_df.index.tz is None
+
+
+def test_parse_copy_csv_reads_postgres_copy_output():
+    # as sent by COPY (...) TO STDOUT WITH (FORMAT csv, HEADER true)
+    csv_buffer = BytesIO(
+        b"timestamp,longitude,latitude,precipitation\n"
+        b"2002-07-02 00:00:00+00,4.5,50.5,1.25\n"
+        b"2002-07-01 22:00:00-02,4.5,50.5,\n"
+    )
+    df = parse_copy_csv(csv_buffer)
+    assert list(df.columns) == ["timestamp", "longitude", "latitude", "precipitation"]
+    assert (df["timestamp"] == pd.Timestamp("2002-07-02", tz="UTC")).all()
+    assert df["precipitation"].dtype == np.float64
+    assert df["precipitation"].isna().tolist() == [False, True]
+
+
+def test_parse_copy_csv_keeps_na_strings_as_text():
+    csv_buffer = BytesIO(
+        b"timestamp,stock_symbol,price_close\n"
+        b"2002-07-02 00:00:00+00,NA,1.25\n"
+        b"2002-07-02 00:00:00+00,NULL,\n"
+        b"2002-07-02 00:00:00+00,nan,2.5\n"
+        b"2002-07-02 00:00:00+00,,3.5\n"
+    )
+    df = parse_copy_csv(csv_buffer)
+    assert df["stock_symbol"].tolist()[:3] == ["NA", "NULL", "nan"]
+    assert df["stock_symbol"].isna().tolist() == [False, False, False, True]
+    assert df["price_close"].isna().tolist() == [False, True, False, False]
+
+
+def test_query_database_to_TimeSeries_copy_needs_postgres(
+    fixt_weather_sqlite_engine,
+):
+    with pytest.raises(ValueError):
+        query_database_to_TimeSeries(
+            sql_alchemy_engine=fixt_weather_sqlite_engine,
+            query="SELECT * FROM weather;",
+            numeric_col_name="precipitation",
+            use_copy=True,
+        )
+
+
+@pytest.mark.parametrize("days_per_partition,max_workers", [(1, 1), (1, 3), (2, 2)])
+def test_query_database_partitions_matches_single_query(
+    fixt_weather_sqlite_engine, days_per_partition, max_workers
+):
+    query_object = CorrDatabaseQuery(
+        select_fields=["timestamp", "longitude", "latitude", "precipitation"],
+        from_database="weather",
+        process_begin_and_end_timestamp=(datetime(2002, 6, 30), datetime(2002, 7, 6)),
+    )
+    partition_queries = query_object.to_sql_partitions(
+        days_per_partition=days_per_partition
+    )
+    assert len(partition_queries) == -(-7 // days_per_partition)
+
+    @flow
+    def query_both():
+        return (
+            query_database(
+                sql_alchemy_engine=fixt_weather_sqlite_engine,
+                query=query_object.to_sql(),
+            ),
+            query_database_partitions(
+                sql_alchemy_engine=fixt_weather_sqlite_engine,
+                queries=partition_queries,
+                max_workers=max_workers,
+            ),
+        )
+
+    single_df, partitioned_df = query_both()
+    assert len(single_df) == 30
+    pandas.testing.assert_frame_equal(partitioned_df, single_df)
+
+
+@pytest.mark.parametrize("read_option", [{"fetch_size": 4}, {"use_copy": True}])
+def test_query_database_to_TimeSeries_partitions_reject_single_query_options(
+    fixt_weather_sqlite_engine, read_option
+):
+    query_object = CorrDatabaseQuery(
+        select_fields=["timestamp", "longitude", "latitude", "precipitation"],
+        from_database="weather",
+        process_begin_and_end_timestamp=(datetime(2002, 7, 1), datetime(2002, 7, 5)),
+    )
+    with pytest.raises(ValueError):
+        query_database_to_TimeSeries(
+            sql_alchemy_engine=fixt_weather_sqlite_engine,
+            query=query_object.to_sql_partitions(),
+            numeric_col_name="precipitation",
+            read_workers=2,
+            **read_option,
+        )
+
+
+def test_query_result_cache_hits_misses_and_data_version(
+    fixt_weather_sqlite_engine, tmp_path
+):
+    query = "SELECT timestamp, longitude, latitude, precipitation FROM weather;"
+    query_cache = QueryResultCache(cache_folder=tmp_path / "query_cache")
+    time_series_list = [
+        fetch_weather_to_TimeSeries(
+            sql_alchemy_engine=fixt_weather_sqlite_engine,
+            query=query,
+            numeric_col_name="precipitation",
+            fetch_size=4,  # parses the sqlite timestamp text
+            query_cache=query_cache,
+        )
+        for _ in range(2)
+    ]
+    assert (query_cache.hits, query_cache.misses) == (1, 1)
+    pandas.testing.assert_frame_equal(
+        time_series_list[0].time_series_df, time_series_list[1].time_series_df
+    )
+
+    # another data version is another key
+    query_cache.data_version = "reingested"
+    assert query_cache.get(fixt_weather_sqlite_engine, query) is None
+    assert len(list((tmp_path / "query_cache").glob("*.arrow"))) == 1
+
+
+def test_query_result_cache_evicts_least_recently_used(
+    fixt_weather_sqlite_engine, tmp_path
+):
+    query_cache = QueryResultCache(cache_folder=tmp_path)
+    df = pd.DataFrame({"precipitation": np.arange(1000, dtype=np.float64)})
+    for query in ("a", "b"):
+        query_cache.put(fixt_weather_sqlite_engine, query, df)
+    file_size = query_cache._cache_path(fixt_weather_sqlite_engine, "a").stat().st_size
+    # "a" is the oldest; reading it makes "b" the least recently used
+    os.utime(query_cache._cache_path(fixt_weather_sqlite_engine, "b"), (1, 1))
+    pandas.testing.assert_frame_equal(
+        query_cache.get(fixt_weather_sqlite_engine, "a"), df
+    )
+
+    query_cache.max_size_in_bytes = 2 * file_size
+    query_cache.put(fixt_weather_sqlite_engine, "c", df)
+    assert query_cache.get(fixt_weather_sqlite_engine, "b") is None
+    assert query_cache.get(fixt_weather_sqlite_engine, "a") is not None
+    assert query_cache.get(fixt_weather_sqlite_engine, "c") is not None
+
+
+def test_query_result_cache_hit_is_memory_mapped(fixt_weather_sqlite_engine, tmp_path):
+    query_cache = QueryResultCache(cache_folder=tmp_path)
+    df = pd.DataFrame({"precipitation": np.arange(1000, dtype=np.float64)})
+    query_cache.put(fixt_weather_sqlite_engine, "a", df)
+    cached_df = query_cache.get(fixt_weather_sqlite_engine, "a")
+    # zero-copy: a read-only view of the mapped file
+    assert not cached_df["precipitation"].to_numpy().flags.writeable
+
+    query_cache.max_size_in_bytes = 0
+    query_cache.evict()
+    assert not list(tmp_path.glob("*.arrow"))
+    pandas.testing.assert_frame_equal(cached_df, df)
+
+
+def test_precipitation_cube_window_matches_pivot(fixt_weather_sqlite_engine, tmp_path):
+    build_precipitation_cube(
+        sql_alchemy_engine=fixt_weather_sqlite_engine,
+        cube_folder=tmp_path / "cube",
+        begin_date=datetime(2002, 6, 30),
+        end_date=datetime(2002, 7, 6),
+        dtype="float64",
+        days_per_partition=3,
+    )
+    pivoted_time_series = query_database_to_TimeSeries(
+        sql_alchemy_engine=fixt_weather_sqlite_engine,
+        query="SELECT timestamp, longitude, latitude, precipitation FROM weather;",
+        numeric_col_name="precipitation",
+        fetch_size=100,
+    )
+    pivoted_time_series.pivot_rows_to_cols(
+        index="timestamp",
+        columns=["latitude", "longitude"],
+        values="precipitation",
+    )
+
+    cube_time_series = fetch_weather_to_TimeSeries(
+        cube_folder=tmp_path / "cube",
+        begin_timestamp=datetime(2002, 7, 1),
+        end_timestamp=datetime(2002, 7, 5),
+        numeric_col_name="precipitation",
+    )
+    # the grid point with a NULL is dropped by both
+    assert cube_time_series.time_series_df.shape == (5, 5)
+    pandas.testing.assert_frame_equal(
+        cube_time_series.time_series_df, pivoted_time_series.time_series_df
+    )
+
+
+def test_precipitation_cube_skips_rows_outside_the_cube(
+    fixt_weather_sqlite_engine, tmp_path
+):
+    with fixt_weather_sqlite_engine.begin() as connection:
+        # within the sql bounds as text, but the day before begin_date in UTC
+        connection.exec_driver_sql(
+            "INSERT INTO weather VALUES ('2002-06-30T01:00:00+02:00', 4.0, 50.0, 9.0)"
+        )
+    build_precipitation_cube(
+        sql_alchemy_engine=fixt_weather_sqlite_engine,
+        cube_folder=tmp_path / "cube",
+        begin_date=datetime(2002, 6, 30),
+        end_date=datetime(2002, 7, 6),
+        dtype="float64",
+    )
+    cube = PrecipitationCube(cube_folder=tmp_path / "cube")
+    # get_indexer's -1 would have written into the last day
+    assert np.isnan(cube._values[0]).all()
+    assert np.isnan(cube._values[-1]).all()
+    assert not (np.asarray(cube._values) == 9.0).any()
+
+
+def test_precipitation_cube_window_is_a_view(tmp_path):
+    dates = pd.date_range("2002-07-01", periods=10, freq="D")
+    grid_df = pd.DataFrame({"latitude": [50.0, 50.0], "longitude": [4.0, 4.5]})
+    values = PrecipitationCube.create(tmp_path, dates, grid_df)
+    values[:] = np.arange(1, 21, dtype=np.float32).reshape(10, 2)
+    values.flush()
+    del values
+
+    cube = PrecipitationCube(cube_folder=tmp_path)
+    window_df = cube.window(datetime(2002, 7, 3), datetime(2002, 7, 6))
+    assert list(window_df.index) == list(dates[2:6])
+    window_np_array = window_df.to_numpy()
+    assert window_np_array.flags.c_contiguous
+    assert np.shares_memory(window_np_array, cube._values)
+    np.testing.assert_array_equal(window_np_array[0], [5, 6])
+
+
+@pytest.mark.parametrize(
+    "columns,dtype",
+    [
+        ("latitude", np.float64),
+        (["latitude"], np.float64),
+        (["latitude", "longitude"], np.float64),
+        (["longitude", "latitude"], np.float32),
+    ],
+)
+def test_pivot_without_aggregation_matches_pivot_table(columns, dtype):
+    rng = np.random.default_rng(seed=2)
+    long_df = pd.DataFrame(
+        {
+            "latitude": np.repeat([50.5, 50.0, 51.0], 8),
+            "longitude": np.tile(np.repeat([4.5, 4.0], 4), 3),
+            "precipitation": rng.gamma(shape=0.8, scale=4, size=24).astype(dtype),
+        },
+        index=pd.DatetimeIndex(
+            np.tile(pd.date_range("2002-07-01", periods=4, freq="D")[::-1], 6),
+            name="timestamp",
+        ),
+    )
+    long_df.iloc[[3, 17], 2] = np.nan  # left out, like pivot_table does
+    long_df = long_df.drop(long_df.index[[5]])  # a missing pair becomes NaN
+    if columns == "latitude" or columns == ["latitude"]:
+        long_df = long_df[long_df["longitude"] == 4.5]
+
+    wide_df = pivot_without_aggregation(
+        long_df, index="timestamp", columns=columns, values="precipitation"
+    )
+    pandas.testing.assert_frame_equal(
+        wide_df,
+        pd.pivot_table(
+            long_df, index="timestamp", columns=columns, values="precipitation"
+        ),
+    )
+
+
+def test_pivot_without_aggregation_drops_nan_keys():
+    long_df = pd.DataFrame(
+        {
+            "latitude": [50.5, np.nan, 50.0, 50.5, 50.0, 50.0],
+            "precipitation": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+        },
+        index=pd.DatetimeIndex(
+            [
+                "2002-07-01",
+                "2002-07-01",
+                "2002-07-01",
+                "2002-07-02",
+                "2002-07-02",
+                None,
+            ],
+            name="timestamp",
+        ),
+    )
+    wide_df = pivot_without_aggregation(
+        long_df, index="timestamp", columns="latitude", values="precipitation"
+    )
+    pandas.testing.assert_frame_equal(
+        wide_df,
+        pd.pivot_table(
+            long_df, index="timestamp", columns="latitude", values="precipitation"
+        ),
+    )
+    assert list(wide_df.columns) == [50.0, 50.5]
+
+
+def test_pivot_rows_to_cols_aggregates_duplicates():
+    long_df = pd.DataFrame(
+        {"stock_symbol": ["A", "A", "B", "A"], "price_close": [1.0, 3.0, 2.0, 4.0]},
+        index=pd.DatetimeIndex(
+            ["2002-07-01", "2002-07-01", "2002-07-01", "2002-07-02"], name="timestamp"
+        ),
+    )
+    assert (
+        pivot_without_aggregation(
+            long_df, index="timestamp", columns="stock_symbol", values="price_close"
+        )
+        is None
+    )
+    time_series = StockTimeSeries(
+        timestamp_index_name="timestamp",
+        numeric_col_name="price_close",
+        time_series_df=long_df,
+    )
+    time_series.pivot_rows_to_cols(
+        index="timestamp", columns="stock_symbol", values="price_close"
+    )
+    # mean of the duplicates; B misses a day, so dropna(axis=1) drops it
+    assert list(time_series.time_series_df.columns) == ["A"]
+    assert time_series.time_series_df.loc["2002-07-01", "A"] == 2.0
+
+
+def test_sql_pushdown_matches_pandas_cleaning(fixt_weather_sqlite_engine):
+    with fixt_weather_sqlite_engine.begin() as connection:
+        # a 0 value & a missing day; both grid points drop out after the pivot
+        connection.exec_driver_sql(
+            "UPDATE weather SET precipitation = 0"
+            " WHERE longitude = 4.0 AND latitude = 50.0"
+            " AND timestamp LIKE '2002-07-02%'"
+        )
+        connection.exec_driver_sql(
+            "DELETE FROM weather WHERE longitude = 5.0 AND latitude = 50.5"
+            " AND timestamp LIKE '2002-07-03%'"
+        )
+    query_kwargs = {
+        "select_fields": ["timestamp", "longitude", "latitude", "precipitation"],
+        "from_database": "weather",
+        "process_begin_and_end_timestamp": (
+            datetime(2002, 6, 30),
+            datetime(2002, 7, 6),
+        ),
+    }
+    pushdown_query_object = CorrDatabaseQuery(
+        filter_numeric_col_name="precipitation",
+        complete_uid_col_names=["latitude", "longitude"],
+        sql_dialect="sqlite",
+        **query_kwargs,
+    )
+
+    with pytest.raises(ValueError):
+        pushdown_query_object.to_sql_partitions(days_per_partition=2)
+
+    @flow
+    def query_whole_interval_and_partitions():
+        complete_uids = list(
+            query_database(
+                sql_alchemy_engine=fixt_weather_sqlite_engine,
+                query=pushdown_query_object.to_complete_uids_sql(),
+            ).itertuples(index=False, name=None)
+        )
+        partition_queries = pushdown_query_object.to_sql_partitions(
+            days_per_partition=2, complete_uids=complete_uids
+        )
+        # the completeness is aggregated once, not in every partition
+        assert not any("HAVING" in query for query in partition_queries)
+        return (
+            query_database(
+                sql_alchemy_engine=fixt_weather_sqlite_engine,
+                query=pushdown_query_object.to_sql(),
+            ),
+            query_database_partitions(
+                sql_alchemy_engine=fixt_weather_sqlite_engine,
+                queries=partition_queries,
+            ),
+        )
+
+    # per partition the completeness still holds over the whole interval
+    whole_interval_df, partitions_df = query_whole_interval_and_partitions()
+    sort_cols = ["timestamp", "latitude", "longitude"]
+    pandas.testing.assert_frame_equal(
+        partitions_df.sort_values(sort_cols, ignore_index=True),
+        whole_interval_df.sort_values(sort_cols, ignore_index=True),
+    )
+
+    results = []
+    for query_object in (CorrDatabaseQuery(**query_kwargs), pushdown_query_object):
+        time_series = query_database_to_TimeSeries(
+            sql_alchemy_engine=fixt_weather_sqlite_engine,
+            query=query_object.to_sql(),
+            numeric_col_name="precipitation",
+            fetch_size=100,
+        )
+        results.append(len(time_series.time_series_df))
+        time_series.pivot_rows_to_cols(
+            index="timestamp",
+            columns=["latitude", "longitude"],
+            values="precipitation",
+        )
+        results.append(time_series.time_series_df)
+
+    pandas_rows, pandas_wide_df, pushdown_rows, pushdown_wide_df = results
+    # 3 of the 6 grid points are incomplete, only the 3 others are transferred
+    assert pushdown_rows == 3 * 5 < pandas_rows
+    assert pandas_wide_df.shape == (5, 3)
+    pandas.testing.assert_frame_equal(pushdown_wide_df, pandas_wide_df)
+
+
+def test_compact_dtypes_keep_stock_time_series_methods_working(
+    fixt_time_series_date_missing,
+):
+    @flow
+    def compact_stock_time_series():
+        return StockTimeSeries(
+            numeric_col_name="close_price",
+            timestamp_index_name="timestamp",
+            time_series_df=compact_dtypes(
+                df=fixt_time_series_date_missing.time_series_df,
+                numeric_col_name="close_price",
+            ),
+        )
+
+    time_series = compact_stock_time_series()
+    assert time_series.time_series_df["close_price"].dtype == np.float32
+    assert time_series.time_series_df["stock_symbol"].dtype == "category"
+
+    dates = time_series.calc_longest_consecutive_days_sequence(treshold=2)
+    assert dates == tuple(pd.date_range("2002-07-07", "2002-07-09", freq="D"))
+    time_series.drop_row_except(dates)
+    time_series.pivot_rows_to_cols(
+        index="timestamp", columns="stock_symbol", values="close_price"
+    )
+    assert list(time_series.time_series_df.columns) == ["A", "B"]
+    assert time_series.find_movers_and_shakers(
+        start_date=dates[0],
+        end_date=dates[-1],
+        min_stocks_output=2,
+        max_stocks_output=2,
+    ) == (
+        ("B", approx(0.45269207087637686, rel=1e-5)),
+        ("A", approx(0.12106212702965258, rel=1e-5)),
+    )
+
+
+def test_compact_ingest_matches_default_ingest(fixt_weather_sqlite_engine):
+    wide_dfs = []
+    for compact in (False, True):
+        time_series = query_database_to_TimeSeries(
+            sql_alchemy_engine=fixt_weather_sqlite_engine,
+            query="SELECT timestamp, longitude, latitude, precipitation FROM weather;",
+            numeric_col_name="precipitation",
+            fetch_size=100,
+            compact=compact,
+        )
+        time_series.pivot_rows_to_cols(
+            index="timestamp",
+            columns=["latitude", "longitude"],
+            values="precipitation",
+            dtype="float32",
+        )
+        wide_dfs.append(time_series.time_series_df)
+    pandas.testing.assert_frame_equal(wide_dfs[1], wide_dfs[0])
+
+
+@pytest.mark.parametrize("fetch_size", [1, 4, 1000])
+def test_stream_query_database_compacts_per_batch(
+    fixt_weather_sqlite_engine, fetch_size
+):
+    query = "SELECT timestamp, longitude, latitude, precipitation FROM weather;"
+
+    @flow
+    def stream_both():
+        return (
+            stream_query_database(
+                sql_alchemy_engine=fixt_weather_sqlite_engine,
+                query=query,
+                fetch_size=fetch_size,
+            ),
+            stream_query_database(
+                sql_alchemy_engine=fixt_weather_sqlite_engine,
+                query=query,
+                fetch_size=fetch_size,
+                compact_numeric_col_name="precipitation",
+            ),
+        )
+
+    streamed_df, compact_streamed_df = stream_both()
+    pandas.testing.assert_frame_equal(
+        compact_streamed_df,
+        streamed_df.astype(
+            {
+                "longitude": "category",
+                "latitude": "category",
+                "precipitation": "float32",
+            }
+        ),
+    )
+
+
+def test_parse_copy_csv_compacts_while_parsing():
+    csv_text = (
+        b"timestamp,stock_symbol,price_close\n"
+        b"2002-07-02 00:00:00+00,B,1.25\n"
+        b"2002-07-02 00:00:00+00,A,\n"
+        b"2002-07-01 00:00:00+00,,2.5\n"
+    )
+    compact_df = parse_copy_csv(
+        BytesIO(csv_text), compact_numeric_col_name="price_close"
+    )
+    pandas.testing.assert_frame_equal(
+        compact_df,
+        parse_copy_csv(BytesIO(csv_text)).astype(
+            {"stock_symbol": "category", "price_close": "float32"}
+        ),
+    )
+
+
+@pytest.mark.parametrize("validation_mode", ["pandera", "numpy", "sampled"])
+def test_validation_modes_agree(validation_mode):
+    long_df = pd.DataFrame(
+        {
+            "stock_symbol": ["A", "A", "B", "B"],
+            "close_price": [16.168, 21.617, 0.0, 14.617],
+        },
+        index=pd.Index(
+            ["2002-07-05", "2002-07-07", "2002-07-05", "2002-07-07"], name="timestamp"
+        ),
+    )
+    time_series, pandera_time_series = (
+        StockTimeSeries(
+            numeric_col_name="close_price",
+            timestamp_index_name="timestamp",
+            time_series_df=long_df.copy(),
+            validation_mode=mode,
+        )
+        for mode in (validation_mode, "pandera")
+    )
+    pandas.testing.assert_frame_equal(
+        time_series.time_series_df, pandera_time_series.time_series_df
+    )
+
+    negative_df = long_df.copy()
+    negative_df.iloc[1, 1] = -1.3
+    with pytest.raises(SchemaError):
+        StockTimeSeries(
+            numeric_col_name="close_price",
+            timestamp_index_name="timestamp",
+            time_series_df=negative_df,
+            validation_mode=validation_mode,
+        )
+
+
+@pytest.mark.parametrize("validation_mode", ["pandera", "numpy", "sampled"])
+@pytest.mark.parametrize(
+    "timestamps",
+    [
+        ["2002-07-01", "2002-07-02", None, "2002-07-02"],
+        ["2002-07-01", "2002-07-02", "no date", "2002-07-02"],
+    ],
+)
+def test_validation_modes_reject_invalid_index(validation_mode, timestamps):
+    with pytest.raises(SchemaError):
+        StockTimeSeries(
+            numeric_col_name="close_price",
+            timestamp_index_name="timestamp",
+            time_series_df=pd.DataFrame(
+                {
+                    "stock_symbol": ["A", "A", "A", "B"],
+                    "close_price": [1.0, 2.0, 3.0, 4.0],
+                },
+                index=pd.Index(timestamps, name="timestamp"),
+            ),
+            validation_mode=validation_mode,
+        )
+
+
+def test_validation_mode_numpy_rejects_non_float():
+    with pytest.raises(SchemaError):
+        StockTimeSeries(
+            numeric_col_name="close_price",
+            timestamp_index_name="timestamp",
+            time_series_df=pd.DataFrame(
+                {"close_price": [1, 2]},
+                index=pd.DatetimeIndex(["2002-07-05", "2002-07-06"], name="timestamp"),
+            ),
+            validation_mode="numpy",
+        )
+
+
+def test_time_series_cleaning_matches_separate_steps():
+    rng = np.random.default_rng(seed=4)
+    long_df = pd.DataFrame(
+        {
+            "stock_symbol": rng.choice(["A", "B", "C", None], size=200),
+            "close_price": rng.choice([0.0, np.nan, 1.5, 2.5, 7.0], size=200),
+        },
+        index=pd.DatetimeIndex(
+            rng.choice(pd.date_range("2002-07-01", periods=20), size=200),
+            name="timestamp",
+        ),
+    )
+    original_df = long_df.copy()
+
+    expected_df = long_df[long_df["close_price"] != 0].dropna()
+    expected_df = expected_df.sort_index(ascending=False)
+    time_series = StockTimeSeries(
+        numeric_col_name="close_price",
+        timestamp_index_name="timestamp",
+        time_series_df=long_df,
+    )
+    pandas.testing.assert_frame_equal(time_series.time_series_df, expected_df)
+    pandas.testing.assert_frame_equal(long_df, original_df)
+
+    # already clean & sorted: no copy of the data
+    clean_df = expected_df.copy()
+    time_series = StockTimeSeries(
+        numeric_col_name="close_price",
+        timestamp_index_name="timestamp",
+        time_series_df=clean_df,
+    )
+    assert np.shares_memory(
+        time_series.time_series_df["close_price"].to_numpy(),
+        clean_df["close_price"].to_numpy(),
+    )
+
+
+def test_trading_calendar_matches_longest_consecutive_days_sequences(
+    fixt_time_series_date_missing, tmp_path
+):
+    stock_df = fixt_time_series_date_missing.time_series_df.reset_index()
+    stock_df = pd.concat(
+        [
+            stock_df,
+            pd.DataFrame(  # leaves out 0, as TimeSeries does
+                {"timestamp": ["2002-07-06"], "stock_symbol": ["A"], "close_price": 0}
+            ),
+        ]
+    )
+    stock_df["timestamp"] = pd.to_datetime(stock_df["timestamp"]).dt.strftime(
+        "%Y-%m-%dT00:00:00+00:00"
+    )
+    sql_alchemy_engine = create_engine(f"sqlite:///{tmp_path / 'stock.db'}")
+    stock_df.to_sql("stock_timedata", sql_alchemy_engine, index=False)
+    build_trading_calendar(
+        sql_alchemy_engine=sql_alchemy_engine,
+        calendar_folder=tmp_path / "calendar",
+        treshold=2,
+        numeric_col_name="close_price",
+    )
+
+    calendar = TradingCalendar(calendar_folder=tmp_path / "calendar")
+    assert calendar.symbol_count(datetime(2002, 7, 5)) == 2
+    assert calendar.symbol_count(datetime(2002, 7, 6)) == 0
+    windows = [
+        (pd.Timestamp(begin_day), pd.Timestamp(end_day))
+        for begin_day, end_day in combinations(
+            pd.date_range("2002-07-03", "2002-07-11", freq="D"), 2
+        )
+    ]
+    assert [
+        calendar.longest_sequence(begin_timestamp, end_timestamp)
+        for begin_timestamp, end_timestamp in windows
+    ] == fixt_time_series_date_missing.calc_longest_consecutive_days_sequences(
+        windows=windows, treshold=2
+    )
+
+
+def test_drop_row_except_day_positions_match_isin(fixt_time_series_date_missing):
+    time_series_df = fixt_time_series_date_missing.time_series_df
+    for keep_list in (
+        tuple(pd.date_range("2002-07-06", "2002-07-08", freq="D")),
+        (pd.Timestamp("2002-07-05"), pd.Timestamp("2002-07-08")),
+        (pd.Timestamp("2002-07-08 12:00"),),
+    ):
+        fixt_time_series_date_missing.time_series_df = time_series_df
+        fixt_time_series_date_missing.drop_row_except(keep_list)
+        pandas.testing.assert_frame_equal(
+            fixt_time_series_date_missing.time_series_df,
+            time_series_df[time_series_df.index.isin(keep_list)],
+        )
+
+
+def test_find_movers_and_shakers_long_matches_after_pivot():
+    rng = np.random.default_rng(seed=2)
+    days = pd.date_range("2002-07-01", periods=5, freq="D")
+    long_df = pd.DataFrame(
+        {
+            "timestamp": np.repeat(days, 50),
+            "stock_symbol": np.tile([f"S{symbol:02}" for symbol in range(50)], 5),
+            "price_close": rng.gamma(shape=2, scale=20, size=250),
+        }
+    )
+    long_df = long_df.drop(index=rng.choice(250, size=20, replace=False))
+    long_df = long_df.set_index("timestamp")
+
+    def stock_time_series():
+        return StockTimeSeries(
+            numeric_col_name="price_close",
+            timestamp_index_name="timestamp",
+            time_series_df=long_df,
+        )
+
+    wide_time_series = stock_time_series()
+    wide_time_series.pivot_rows_to_cols(
+        index="timestamp", columns="stock_symbol", values="price_close"
+    )
+    largest_stocks = wide_time_series.find_movers_and_shakers(
+        start_date=days[0], end_date=days[-1], min_stocks_output=6, max_stocks_output=6
+    )
+    wide_time_series.drop_col_except([stock[0] for stock in largest_stocks])
+
+    long_time_series = stock_time_series()
+    # symbols without a row on the start date: no 0 / 0 warning
+    with np.errstate(all="raise"):
+        long_largest_stocks = long_time_series.find_movers_and_shakers_long(
+            start_date=days[0],
+            end_date=days[-1],
+            min_stocks_output=6,
+            max_stocks_output=6,
+        )
+    assert long_largest_stocks == largest_stocks
+    long_time_series.drop_symbol_rows_except([stock[0] for stock in largest_stocks])
+    long_time_series.pivot_rows_to_cols(
+        index="timestamp", columns="stock_symbol", values="price_close"
+    )
+    long_time_series.drop_col_except([stock[0] for stock in largest_stocks])
+    pandas.testing.assert_frame_equal(
+        long_time_series.time_series_df, wide_time_series.time_series_df
+    )
+    with pytest.raises(ValueError):
+        stock_time_series().find_movers_and_shakers_long(
+            start_date=days[0],
+            end_date=days[-1],
+            min_stocks_output=60,
+            max_stocks_output=60,
+        )
+
+
+def test_flow_sql_pushdown_with_read_workers(fixt_flow_sqlite_conn_strings, tmp_path):
+    stocks_db_conn_string, datasets_db_conn_string = fixt_flow_sqlite_conn_strings
+    corr_dict_folder = tmp_path / "corr_dicts"
+    corr_dict_folder.mkdir()
+    main_flow.stock_correlation_flow(
+        corr_dict_pickle_storage_path=corr_dict_folder,
+        posts_per_day=1,  # 6 stocks
+        stocks_db_conn_string=stocks_db_conn_string,
+        datasets_db_conn_string=datasets_db_conn_string,
+        target_date=datetime(2002, 7, 3),
+        datasets_sql_pushdown=True,
+        datasets_read_workers=2,
+    )
+    (corr_dict_pickle_path,) = corr_dict_folder.iterdir()
+    corr_dict = pd.read_pickle(corr_dict_pickle_path)
+    assert len(corr_dict) == 6
+    for stock_corr in corr_dict.values():
+        assert len(stock_corr["dataset_pd_series"]) == 5
+        # the 2 incomplete grid points are left out in sql
+        assert stock_corr["dataset_uid"] not in ((50.5, 4.0), (50.0, 4.5))
+
+
+def test_flow_rolling_backend_keeps_the_callers_engine(
+    fixt_flow_sqlite_conn_strings, tmp_path
+):
+    stocks_db_conn_string, datasets_db_conn_string = fixt_flow_sqlite_conn_strings
+    rolling_correlation = RollingCorrelation()
+    for _ in range(2):
+        main_flow.stock_correlation_flow(
+            corr_dict_pickle_storage_path=tmp_path,
+            posts_per_day=1,
+            stocks_db_conn_string=stocks_db_conn_string,
+            datasets_db_conn_string=datasets_db_conn_string,
+            target_date=datetime(2002, 7, 3),
+            correlation_backend="rolling",
+            rolling_correlation=rolling_correlation,
+        )
+    # the same window twice; the second run reuses the sums of the first
+    assert rolling_correlation.full_calculation_count == 1
+    assert rolling_correlation.incremental_update_count == 1